@@ -0,0 +1,198 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import argparse
+import collections
+import os
+import tempfile
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+
+from gz_blocks import BGZF_BLOCK_DATA, BGZF_EOF, bgzf_block, iter_decompressed, scan_gzips, write_gzi, write_read_index
+
+BLOCKS_PER_JOB = 64
+
+def parse_args():
+	"""
+	Calls arguments used at the command line.
+
+	Args:
+		required:
+			- inputs (str): .fastq.gz files to convert.
+	Returns:
+		- args (str): arg parser object.
+	"""
+
+	parser = argparse.ArgumentParser(description="Rewrite FASTQ.gz files as BGZF with a .gzi block index and a read-offset sidecar.")
+	parser.add_argument("inputs",
+						nargs='+',
+						help=".fastq.gz files to convert.")
+	parser.add_argument("-output_dir",
+						type=str,
+						help="directory the converted files (and their .gzi/.fqi) are written to, under the same names.")
+	parser.add_argument("--in_place",
+						action="store_true",
+						help="replace each input with its BGZF version instead (the swap is atomic and only happens after verification).")
+	parser.add_argument("--read_stride",
+						type=int,
+						default=1000,
+						help="record the offset of every Nth read in the .fqi sidecar.")
+	parser.add_argument("--level",
+						type=int,
+						default=6,
+						help="zlib compression level.")
+	parser.add_argument("--processes",
+						type=int,
+						help="number of processes compressing blocks (default: one per CPU).")
+	args = parser.parse_args()
+
+	if bool(args.output_dir) == args.in_place:
+		parser.error("give exactly one of -output_dir or --in_place")
+
+	return args
+
+def _compress_blocks(args):
+
+	blocks, level = args
+	return [bgzf_block(block, level) for block in blocks]
+
+def _iter_blocks(path):
+	"""
+	Re-chunks the decompressed content of path into BGZF_BLOCK_DATA-sized pieces.
+	"""
+
+	pending = b''
+	for data in iter_decompressed(path):
+		data = pending + data
+		end = len(data) - len(data) % BGZF_BLOCK_DATA
+		for start in range(0, end, BGZF_BLOCK_DATA):
+			yield data[start:start + BGZF_BLOCK_DATA]
+		pending = data[end:]
+	if pending:
+		yield pending
+
+def _iter_jobs(path, level):
+
+	batch = []
+	for block in _iter_blocks(path):
+		batch.append(block)
+		if len(batch) == BLOCKS_PER_JOB:
+			yield batch, level
+			batch = []
+	if batch:
+		yield batch, level
+
+class ReadOffsets:
+	"""
+	Tracks the uncompressed offset of every stride-th FASTQ record as content streams past.
+	"""
+
+	def __init__(self, stride):
+		self.stride = stride
+		self.lines = 0
+		self.position = 0
+		self.offsets = []
+
+	def update(self, data):
+		if not self.position and data:
+			self.offsets.append(0)
+		newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+		# the newline ending line L (0-based, whole stream) starts record (L + 1) / 4 when L % 4 == 3
+		line_numbers = self.lines + np.arange(len(newlines))
+		starts = (line_numbers % 4 == 3) & ((line_numbers + 1) // 4 % self.stride == 0)
+		self.offsets.extend((self.position + newlines[starts] + 1).tolist())
+		self.lines += len(newlines)
+		self.position += len(data)
+
+	def read_count(self):
+		return self.lines // 4
+
+def convert(path, outfile, pool, stride=1000, level=6, max_in_flight=32):
+	"""
+	Rewrites one FASTQ.gz as BGZF. Decompression is a single stream; block compression is spread over pool, with at
+	most max_in_flight jobs outstanding so memory stays flat. The .gzi index and the .fqi read-offset sidecar are
+	written alongside. Before anything is moved into place the output is inflated again (scan_gzips, split over
+	pool) and its CRC32 and size checked against the input's. The data file is moved first and the
+	sidecars after it, with any old ones removed beforehand, so a crash never leaves indexes for the wrong file.
+
+	Args:
+		- path (str): input .fastq.gz (plain, multi-member or BGZF).
+		- outfile (str): where the BGZF file goes; outfile.gzi and outfile.fqi are written next to it.
+		- pool (Executor): runs the block compression.
+	Returns:
+		- read_count (int): number of records in the file.
+	"""
+
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)), prefix='.bgzf_')
+	crc, size = 0, 0
+	entries = []
+	reads = ReadOffsets(stride)
+	in_flight = collections.deque()
+
+	try:
+		with os.fdopen(fd, 'wb') as o:
+			def drain():
+				nonlocal crc, size
+				blocks, future = in_flight.popleft()
+				for block, data in zip(blocks, future.result()):
+					if size:
+						entries.append((o.tell(), size))
+					o.write(data)
+					crc = zlib.crc32(block, crc)
+					size += len(block)
+					reads.update(block)
+
+			for job in _iter_jobs(path, level):
+				in_flight.append((job[0], pool.submit(_compress_blocks, job)))
+				if len(in_flight) >= max_in_flight:
+					drain()
+			while in_flight:
+				drain()
+			o.write(BGZF_EOF)
+		os.chmod(tmp, os.stat(path).st_mode & 0o777)
+
+		if reads.lines % 4:
+			raise ValueError("{} has {} lines, not a multiple of 4".format(path, reads.lines))
+
+		# the .gzi also lets scan_gzips split the check at block boundaries
+		write_gzi(tmp + '.gzi', entries)
+		write_read_index(tmp + '.fqi', stride, reads.read_count(), reads.offsets[:(reads.read_count() + stride - 1) // stride])
+		stats = next(scan_gzips([tmp], pool, max_in_flight))[1]
+		if isinstance(stats, Exception):
+			raise ValueError("BGZF output for {} does not inflate: {}".format(path, stats))
+		if stats['crc32'] != crc or stats['uncompressed_size'] != size:
+			raise ValueError("BGZF output for {} does not match its input".format(path))
+
+		for sidecar in (outfile + '.gzi', outfile + '.fqi'):
+			if os.path.lexists(sidecar):
+				os.remove(sidecar)
+		os.replace(tmp, outfile)
+		os.replace(tmp + '.gzi', outfile + '.gzi')
+		os.replace(tmp + '.fqi', outfile + '.fqi')
+	except BaseException:
+		for leftover in (tmp, tmp + '.gzi', tmp + '.fqi'):
+			if os.path.exists(leftover):
+				os.remove(leftover)
+		raise
+	return reads.read_count()
+
+def main():
+	"""
+	Main function -- converts every input.
+	"""
+
+	args = parse_args()
+	with ProcessPoolExecutor(max_workers=args.processes) as pool:
+		for path in args.inputs:
+			outfile = path if args.in_place else os.path.join(args.output_dir, os.path.basename(path))
+			read_count = convert(path, outfile, pool, args.read_stride, args.level, 2 * (args.processes or os.cpu_count()))
+			print('{}\t{}\t{}'.format(path, outfile, read_count))
+
+if __name__ == "__main__":
+	"""
+	main function that directs flow of code execution
+	"""
+
+	main()
@@ -1,10 +1,36 @@
 # !/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import numpy as np
 import pandas as pd
-import glob
 import argparse
+import bisect
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import math
 import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+from datetime import datetime
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+EDGE_BLOCK_SIZE = 1 << 16
+HASH_CHUNK_SIZE = 1 << 20
+SKETCH_MAGIC = b'IDBDSKT2'
+# exact list entries per independently gzipped block of a sketch
+SKETCH_BLOCK_SIZE = 4096
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+# bumped when signatures stop being comparable with cached ones
+SKETCH_INDEX_VERSION = 2
+READ_BATCH_SIZE = 20000
 
 def parse_args():
 	"""
@@ -21,61 +47,734 @@ def parse_args():
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-input_dir",
 						type=str,
-						help="input is either .txt or .xlsx",
-						required=True)
+						help="input is either .txt or .xlsx")
 	parser.add_argument("--compare_dir",
 						type=str,
 						help="input is either .txt or .xlsx",
 						required=False)
+	parser.add_argument("--content",
+						action="store_true",
+						help="report files with identical content (and hardlinks) as duplicates, instead of identical names.")
+	parser.add_argument("--processes",
+						type=int,
+						help="number of processes used to fully hash candidate duplicates with --content.")
+	parser.add_argument("--external_sort",
+						action="store_true",
+						help="out-of-core mode: spill (basename, path) records to sorted files and merge-join them, in fixed memory.")
+	parser.add_argument("--spill_dir",
+						type=str,
+						help="directory for --external_sort spill files (default: system temp dir).")
+	parser.add_argument("--chunk_size",
+						type=int,
+						default=1000000,
+						help="records held in memory per spill file with --external_sort.")
+	parser.add_argument("--build_sketch",
+						type=str,
+						help="write a membership sketch of input_dir (Bloom filter + exact key list) to this file and exit.")
+	parser.add_argument("--keys_only",
+						action="store_true",
+						help="with --build_sketch, leave paths out of the exact list; for the INPUT_SKETCH side, whose paths are never logged.")
+	parser.add_argument("--suffix",
+						type=str,
+						default='gz',
+						help="file name suffix included in a sketch (use .fastq.gz for the compare side).")
+	parser.add_argument("--false_positive_rate",
+						type=float,
+						default=0.01,
+						help="target Bloom filter false positive rate for --build_sketch.")
+	parser.add_argument("--compare_sketches",
+						type=str,
+						nargs=2,
+						metavar=('INPUT_SKETCH', 'COMPARE_SKETCH'),
+						help="log files in COMPARE_SKETCH whose key is not in INPUT_SKETCH, as check_between_folders does.")
+	parser.add_argument("--near_duplicates",
+						type=str,
+						help="write pairs of FASTQ.gz files whose estimated k-mer Jaccard similarity is at least --jaccard to this TSV.")
+	parser.add_argument("--cp_tsv",
+						type=str,
+						nargs='+',
+						help="take the --near_duplicates files from these cp.tsv files (and report their accession and split) instead of crawling.")
+	parser.add_argument("--sketch_index",
+						type=str,
+						help="MinHash signature cache (.npz) for --near_duplicates; unchanged files are not re-read.")
+	parser.add_argument("--jaccard",
+						type=float,
+						default=0.5,
+						help="minimum estimated Jaccard similarity reported by --near_duplicates.")
+	parser.add_argument("--kmer",
+						type=int,
+						default=21,
+						help="k-mer length for --near_duplicates (at most 31).")
+	parser.add_argument("--scale",
+						type=int,
+						default=1000,
+						help="keep about one k-mer in this many (by hash) before MinHashing.")
+	parser.add_argument("--num_perm",
+						type=int,
+						default=128,
+						help="MinHash signature length.")
+	parser.add_argument("--bands",
+						type=int,
+						default=32,
+						help="LSH bands; num_perm must be divisible by it.")
 	args = parser.parse_args()
 
+	if args.input_dir is None and args.compare_sketches is None and args.cp_tsv is None:
+		parser.error("-input_dir is required unless --compare_sketches or --cp_tsv is given")
+	if args.num_perm % args.bands:
+		parser.error("--num_perm must be divisible by --bands")
+	if args.external_sort and args.content:
+		parser.error("--external_sort compares basenames and cannot be combined with --content")
+	if not 1 <= args.kmer <= 31:
+		parser.error("--kmer must be between 1 and 31")
+
 
 	return args
 
-def check_duplicates(input_dir):
+def _edge_digest(path, size):
+	"""
+	Hashes the first and last EDGE_BLOCK_SIZE bytes of a file (the whole file if it is small).
+	"""
+
+	with open(path, 'rb') as f:
+		h = hashlib.blake2b(f.read(EDGE_BLOCK_SIZE), digest_size=16)
+		if size > EDGE_BLOCK_SIZE:
+			f.seek(max(size - EDGE_BLOCK_SIZE, EDGE_BLOCK_SIZE))
+			h.update(f.read(EDGE_BLOCK_SIZE))
+	return h.hexdigest()
+
+def _full_digest(path):
+
+	h = hashlib.blake2b()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+			h.update(chunk)
+	return path, h.hexdigest()
+
+def find_content_duplicates(paths, processes=None):
+	"""
+	Groups files with identical content in stages, so most bytes are never read:
+		1. files are grouped by size, and paths sharing a device and inode (hardlinks) are merged without reading;
+		2. same-size files are split by a digest of their first and last blocks;
+		3. only files that still collide are fully hashed, across a process pool.
+
+	Returns:
+		- groups (list): lists of two or more paths with identical content.
+	"""
+
+	by_size = {}
+	for path in paths:
+		st = os.stat(path)
+		by_size.setdefault(st.st_size, {}).setdefault((st.st_dev, st.st_ino), []).append(path)
+
+	groups = []
+	edge_candidates = []
+	for size, by_inode in by_size.items():
+		if len(by_inode) == 1:
+			links = list(by_inode.values())[0]
+			if len(links) > 1:
+				groups.append(links)
+		else:
+			edge_candidates.append((size, list(by_inode.values())))
+
+	# one representative path per inode is read from here on; the others ride along in its list
+	with ThreadPoolExecutor() as pool:
+		edge_digests = pool.map(lambda c: [_edge_digest(links[0], c[0]) for links in c[1]], edge_candidates)
+		full_candidates = []
+		for (size, inodes), digests in zip(edge_candidates, edge_digests):
+			by_edge = {}
+			for links, digest in zip(inodes, digests):
+				by_edge.setdefault(digest, []).append(links)
+			for same_edges in by_edge.values():
+				if len(same_edges) == 1:
+					if len(same_edges[0]) > 1:
+						groups.append(same_edges[0])
+				elif size <= 2 * EDGE_BLOCK_SIZE:
+					# the edge blocks already covered the whole file
+					groups.append([path for links in same_edges for path in links])
+				else:
+					full_candidates.append(same_edges)
+
+	with ProcessPoolExecutor(max_workers=processes) as pool:
+		full_digests = dict(pool.map(_full_digest, [links[0] for same_edges in full_candidates for links in same_edges]))
+	for same_edges in full_candidates:
+		by_digest = {}
+		for links in same_edges:
+			by_digest.setdefault(full_digests[links[0]], []).extend(links)
+		groups += [group for group in by_digest.values() if len(group) > 1]
+
+	return groups
+
+def _scan_tree(root, suffix):
+	"""
+	Yields (path, size, mtime_ns) for every non-hidden file under root whose name ends with suffix.
+	"""
+
+	for (dirpath, dirnames, filenames) in os.walk(root):
+		dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+		for file in filenames:
+			if file.endswith(suffix) and not file.startswith('.'):
+				path = os.path.join(dirpath, file)
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				yield path, st.st_size, st.st_mtime_ns
+
+def build_basename_index(input_dir, compare_dir=None):
+	"""
+	Crawls input_dir (files ending in gz) and compare_dir (files ending in .fastq.gz) once and indexes every file by
+	basename, so neither check has to glob the trees again.
+
+	Returns:
+		- index (dict): basename -> {'input': [(path, size, mtime_ns), ...], 'compare': [...]}
+	"""
+
+	index = {}
+	sides = [('input', input_dir, 'gz')]
+	if compare_dir:
+		sides.append(('compare', compare_dir, '.fastq.gz'))
+	for side, root, suffix in sides:
+		for path, size, mtime_ns in _scan_tree(root, suffix):
+			index.setdefault(path.split('/')[-1], {'input': [], 'compare': []})[side].append((path, size, mtime_ns))
+	return index
+
+def _open_logfile():
+
+	logfile = open('/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/to_remove/duplicates.logfile.tsv', 'a')
+	return logfile
+
+def _write_header(logfile):
+
+	logfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format("older_file", "newer_file", "duplicate_in_compared_dir",
+															  "group_size", "older_size", "older_mtime", "newer_size", "newer_mtime"))
+
+def _write_group(logfile, group):
+	"""
+	Logs a group of duplicate (path, size, mtime_ns) entries as one row per copy against the oldest file in it.
+	"""
+
+	group = sorted(group, key=lambda entry: (entry[2], entry[0]))
+	f1, size1, mtime1 = group[0]
+	for f2, size2, mtime2 in group[1:]:
+		logfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(f1, f2, '', len(group), size1, _format_mtime(mtime1), size2, _format_mtime(mtime2)))
+
+def _format_mtime(mtime_ns):
+
+	return datetime.fromtimestamp(mtime_ns / 1e9).isoformat(timespec='seconds')
+
+def check_content_duplicates(input_dir, index, processes=None):
+	"""
+	Content-based check_duplicates: every group of identical files is logged as one row per copy, against the
+	oldest file (by mtime) in the group.
+	"""
+
+	entries = {entry[0]: entry for basename in sorted(index) for entry in index[basename]['input']}
+
+	with _open_logfile() as logfile:
+		_write_header(logfile)
+		for group in sorted(sorted(group) for group in find_content_duplicates(list(entries), processes)):
+			_write_group(logfile, [entries[path] for path in group])
+
+def check_duplicates(input_dir, index):
+	"""
+	Logs every group of two or more files under input_dir that share a basename, ordered by basename.
+	"""
+
+	with _open_logfile() as logfile:
+		_write_header(logfile)
+		for basename in sorted(index):
+			if len(index[basename]['input']) > 1:
+				_write_group(logfile, index[basename]['input'])
+
+def check_between_folders(compare_dir, index):
+	"""
+	Logs every file under compare_dir whose basename does not occur under input_dir.
+	"""
+
+	with _open_logfile() as logfile:
+		for basename in sorted(index):
+			if not index[basename]['input']:
+				for file_long, size, mtime_ns in index[basename]['compare']:
+					logfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(basename, '', file_long, '', '', '', '', ''))
+
+
+def _spill(lines, spill_dir):
+
+	lines.sort()
+	fd, path = tempfile.mkstemp(dir=spill_dir, suffix='.spill')
+	with open(fd, 'w', newline='\n', errors='surrogateescape') as f:
+		f.writelines(lines)
+	return path
+
+def _sorted_records(root, suffix, spill_dir, chunk_size):
+	"""
+	Yields one '\\0'-separated basename, sequence, size, mtime_ns, path record line per file under root, in
+	(basename, crawl order) order. At most chunk_size lines are held in memory: each full chunk is sorted and
+	spilled to a file, and the spill files are merged.
+	"""
+
+	runs = []
+	chunk = []
+	for seq, (path, size, mtime_ns) in enumerate(_scan_tree(root, suffix)):
+		chunk.append('{}\0{:020d}\0{}\0{}\0{}\n'.format(path.split('/')[-1], seq, size, mtime_ns, path))
+		if len(chunk) >= chunk_size:
+			runs.append(_spill(chunk, spill_dir))
+			chunk = []
+	if chunk:
+		runs.append(_spill(chunk, spill_dir))
+
+	files = [open(run, newline='\n', errors='surrogateescape') for run in runs]
+	try:
+		yield from heapq.merge(*files)
+	finally:
+		for f in files:
+			f.close()
+
+def _grouped(records):
+	"""
+	Groups sorted record lines by basename, yielding (basename, [(path, size, mtime_ns), ...]).
+	"""
+
+	for basename, lines in itertools.groupby(records, key=lambda line: line.split('\0', 1)[0]):
+		entries = []
+		for line in lines:
+			_, _, size, mtime_ns, path = line[:-1].split('\0', 4)
+			entries.append((path, int(size), int(mtime_ns)))
+		yield basename, entries
+
+def _merge_join(left, right):
+	"""
+	Full outer merge-join of two basename-sorted group streams, yielding (basename, left_entries, right_entries).
+	"""
+
+	left_group = next(left, None)
+	right_group = next(right, None)
+	while left_group is not None or right_group is not None:
+		if right_group is None or (left_group is not None and left_group[0] < right_group[0]):
+			yield left_group[0], left_group[1], []
+			left_group = next(left, None)
+		elif left_group is None or right_group[0] < left_group[0]:
+			yield right_group[0], [], right_group[1]
+			right_group = next(right, None)
+		else:
+			yield left_group[0], left_group[1], right_group[1]
+			left_group = next(left, None)
+			right_group = next(right, None)
+
+def check_duplicates_external(input_dir, compare_dir=None, spill_dir=None, chunk_size=1000000):
+	"""
+	Out-of-core check_duplicates + check_between_folders for trees too large to index in memory. Both trees are
+	turned into basename-sorted record streams with spill files and merge-joined, so memory stays at one chunk plus
+	one basename group. The log is the same as the in-memory mode's.
+	"""
+
+	work_dir = tempfile.mkdtemp(dir=spill_dir, prefix='duplicates.')
+	try:
+		input_groups = _grouped(_sorted_records(input_dir, 'gz', work_dir, chunk_size))
+		compare_groups = _grouped(_sorted_records(compare_dir, '.fastq.gz', work_dir, chunk_size)) if compare_dir else iter([])
 
-	all_files_list = glob.glob("{}/*/*gz".format(input_dir))
+		# rows for files missing from input_dir come after all duplicate rows, as in the in-memory mode
+		with _open_logfile() as logfile, open(os.path.join(work_dir, 'missing.tsv'), 'w+', newline='\n', errors='surrogateescape') as missing:
+			_write_header(logfile)
+			for basename, input_entries, compare_entries in _merge_join(input_groups, compare_groups):
+				if len(input_entries) > 1:
+					_write_group(logfile, input_entries)
+				elif not input_entries:
+					for file_long, size, mtime_ns in compare_entries:
+						missing.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(basename, '', file_long, '', '', '', '', ''))
+			missing.seek(0)
+			shutil.copyfileobj(missing, logfile)
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
 
-	store_files_set = set()
 
-	with open('/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/to_remove/duplicates.logfile.tsv', 'a') as logfile:
-		logfile.write("{}{}{}{}{}{}".format("older_file",'\t',"newer_file", '\t', "duplicate_in_compared_dir",'\n'))
-		for file_long in all_files_list:
+def _bloom_positions(keys, m_bits, k_hashes):
+	"""
+	Bit positions of keys in an m_bits Bloom filter, by double hashing one 128-bit blake2b digest per key.
+
+	Returns:
+		- positions (ndarray): uint64 array of shape (len(keys), k_hashes).
+	"""
+
+	digests = np.frombuffer(b''.join(hashlib.blake2b(key.encode('utf-8', 'surrogateescape'), digest_size=16).digest() for key in keys),
+							dtype='<u8').reshape(-1, 2)
+	steps = np.arange(k_hashes, dtype=np.uint64)
+	return (digests[:, :1] + steps * (digests[:, 1:] | np.uint64(1))) % np.uint64(m_bits)
+
+def _sketch_keys(input_dir, suffix, content=False, processes=None):
+	"""
+	Returns the sorted (key, path) list for a sketch: the basename, or a blake2b content digest with content=True.
+	"""
+
+	paths = [path for path, size, mtime_ns in _scan_tree(input_dir, suffix)]
+	if content:
+		with ProcessPoolExecutor(max_workers=processes) as pool:
+			entries = [(digest, path) for path, digest in pool.map(_full_digest, paths, chunksize=16)]
+	else:
+		entries = [(path.split('/')[-1], path) for path in paths]
+	return sorted(entries)
+
+def build_sketch(input_dir, outfile, suffix='gz', content=False, false_positive_rate=0.01, processes=None, keys_only=False):
+	"""
+	Writes a compact membership sketch of input_dir: a header, a Bloom filter of the keys (basenames, or content
+	digests with content=True), then the exact (key, path) list used to confirm Bloom filter hits, gzipped in blocks
+	of SKETCH_BLOCK_SIZE entries whose first keys and offsets are in the header. With keys_only the paths are left
+	out. Only this file has to travel between sites.
+	"""
+
+	entries = _sketch_keys(input_dir, suffix, content, processes)
+	n_items = max(len(entries), 1)
+	m_bits = max(8, int(math.ceil(-n_items * math.log(false_positive_rate) / math.log(2) ** 2)))
+	m_bits += -m_bits % 8
+	k_hashes = max(1, int(round(m_bits / n_items * math.log(2))))
+
+	bits = np.zeros(m_bits // 8, dtype=np.uint8)
+	for start in range(0, len(entries), 100000):
+		positions = _bloom_positions([key for key, path in entries[start:start + 100000]], m_bits, k_hashes).ravel()
+		np.bitwise_or.at(bits, positions >> np.uint64(3), np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+
+	blocks = []
+	offset = 0
+	for start in range(0, len(entries), SKETCH_BLOCK_SIZE):
+		chunk = entries[start:start + SKETCH_BLOCK_SIZE]
+		lines = (key if keys_only else '{}\t{}'.format(key, path) for key, path in chunk)
+		blocks.append(gzip.compress(('\n'.join(lines) + '\n').encode('utf-8', 'surrogateescape'), mtime=0))
+	block_index = []
+	for (key, path), block in zip(entries[::SKETCH_BLOCK_SIZE], blocks):
+		block_index.append((key, offset, len(block)))
+		offset += len(block)
+
+	header = json.dumps({'key': 'content' if content else 'name', 'root': input_dir, 'suffix': suffix,
+						 'n_items': len(entries), 'm_bits': m_bits, 'k_hashes': k_hashes, 'keys_only': keys_only,
+						 'blocks': block_index}).encode()
+	with open(outfile, 'wb') as f:
+		f.write(SKETCH_MAGIC)
+		f.write(struct.pack('<I', len(header)))
+		f.write(header)
+		f.write(bits.tobytes())
+		for block in blocks:
+			f.write(block)
+
+	print('{}: {} keys, {} byte Bloom filter, {} hashes'.format(outfile, len(entries), m_bits // 8, k_hashes))
+
+class Sketch:
+	"""
+	Reader for a build_sketch file. The Bloom filter and block index are loaded up front; the exact list is only
+	read on demand, whole (entries) or just the blocks that can hold given keys (contains).
+	"""
 
-			file_short = file_long.split('/')[-1]
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as f:
+			if f.read(len(SKETCH_MAGIC)) != SKETCH_MAGIC:
+				raise ValueError('{} is not a duplicates sketch'.format(path))
+			header_size = struct.unpack('<I', f.read(4))[0]
+			self.header = json.loads(f.read(header_size))
+			self.bits = np.frombuffer(f.read(self.header['m_bits'] // 8), dtype=np.uint8)
+			self.exact_offset = f.tell()
+		self.first_keys = [key for key, offset, length in self.header['blocks']]
 
-			if file_short in store_files_set:
-				
-				duplicates = glob.glob('{}/**/{}'.format(input_dir,file_short), recursive=True)
-				f1 = duplicates[0]
-				f2 = duplicates[1]
+	def might_contain(self, keys):
+		"""
+		Returns a boolean array: False means the key is definitely absent, True means it is probably present.
+		"""
 
-				logfile.write("{}{}{}{}{}{}".format(f1,'\t',f2, '\t', '','\n'))
+		if not keys:
+			return np.zeros(0, dtype=bool)
+		positions = _bloom_positions(keys, self.header['m_bits'], self.header['k_hashes'])
+		return ((self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1).all(axis=1)
 
+	def _block_entries(self, f, block):
+		key, offset, length = self.header['blocks'][block]
+		f.seek(self.exact_offset + offset)
+		for line in gzip.decompress(f.read(length)).decode('utf-8', 'surrogateescape').splitlines():
+			if self.header['keys_only']:
+				yield line, None
 			else:
-				store_files_set.add(file_short)
-		
-		logfile.close()
+				yield tuple(line.split('\t', 1))
+
+	def entries(self):
+		"""
+		Yields the exact (key, path) list in key order; path is None in a keys_only sketch.
+		"""
+
+		with open(self.path, 'rb') as f:
+			for block in range(len(self.first_keys)):
+				yield from self._block_entries(f, block)
+
+	def contains(self, keys):
+		"""
+		Returns the subset of keys in the exact list, decompressing only the blocks their first keys point to.
+		"""
+
+		blocks = {bisect.bisect_right(self.first_keys, key) - 1 for key in keys}
+		found = set()
+		with open(self.path, 'rb') as f:
+			for block in sorted(blocks - {-1}):
+				found.update(key for key, path in self._block_entries(f, block))
+		return found & set(keys)
+
+def compare_sketches(input_sketch, compare_sketch, batch_size=100000):
+	"""
+	check_between_folders on two sketch files: every compare entry is first tested against the input Bloom filter,
+	and only the probable hits are confirmed, by reading just the input exact list blocks that can hold them.
+	Compare entries whose key is not in input are logged in the check_between_folders row format, so the compare
+	sketch needs its paths while the input sketch may be keys_only.
+	"""
+
+	input_sketch = Sketch(input_sketch)
+	compare_sketch = Sketch(compare_sketch)
+	if input_sketch.header['key'] != compare_sketch.header['key']:
+		raise ValueError('Sketch key types differ: {} vs {}'.format(input_sketch.header['key'], compare_sketch.header['key']))
+	if compare_sketch.header['keys_only']:
+		raise ValueError('{} has no paths to report; build the compare side without --keys_only'.format(compare_sketch.path))
+
+	missing = []
+	candidates = []
+	compare_entries = compare_sketch.entries()
+	while True:
+		batch = list(itertools.islice(compare_entries, batch_size))
+		if not batch:
+			break
+		for entry, hit in zip(batch, input_sketch.might_contain([key for key, path in batch])):
+			(candidates if hit else missing).append(entry)
+
+	# second pass: confirm the hits against the input exact list, one batch of candidates at a time
+	false_positives = 0
+	for start in range(0, len(candidates), batch_size):
+		batch = candidates[start:start + batch_size]
+		present = input_sketch.contains([key for key, path in batch])
+		for key, path in batch:
+			if key not in present:
+				missing.append((key, path))
+				false_positives += 1
+
+	with _open_logfile() as logfile:
+		for key, path in sorted(missing, key=lambda entry: (entry[1].split('/')[-1], entry[0], entry[1])):
+			logfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(path.split('/')[-1], '', path, '', '', '', '', ''))
+
+	print('{} compare entries missing from input ({} Bloom filter false positives rejected)'.format(len(missing), false_positives))
+
+
+def _mix64(x):
+	"""
+	splitmix64 finalizer over a uint64 array.
+	"""
+
+	x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+	x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+	return x ^ (x >> np.uint64(31))
+
+def _kmer_hashes(reads, k):
+	"""
+	Hashes every k-mer of a batch of read sequences (bytes) without a Python loop per k-mer.
+	k-mers containing anything other than A/C/G/T, or spanning two reads, are dropped.
+	"""
 
-	return store_files_set, logfile
+	codes = np.full(256, 4, dtype=np.uint8)
+	for i, base in enumerate(b'ACGT'):
+		codes[base] = i
+		codes[base + 32] = i
+	seq = codes[np.frombuffer(b'N'.join(reads), dtype=np.uint8)]
+	if len(seq) < k:
+		return np.zeros(0, dtype=np.uint64)
 
-def check_between_folders(compare_dir, store_files_set, logfile):
+	n_windows = len(seq) - k + 1
+	invalid = np.concatenate(([0], np.cumsum(seq == 4)))
+	valid = (invalid[k:] - invalid[:-k]) == 0
+	values = np.zeros(n_windows, dtype=np.uint64)
+	bits = (seq & 3).astype(np.uint64)
+	for j in range(k):
+		values = (values << np.uint64(2)) | bits[j:j + n_windows]
+	return _mix64(values[valid])
 
-	all_files_list = glob.glob("{}/**/*.fastq.gz".format(compare_dir), recursive=True)
+def _mulmod61(h, a):
+	"""
+	(a * h) mod 2^61-1, up to a final reduction, for h < 2^32 and a < 2^61, without overflowing uint64: a is split
+	at bit 32 and the high product folded with 2^61 = 1 (mod 2^61-1). Results are below 2^63.
+	"""
+
+	high = h * (a >> np.uint64(32))
+	low = h * (a & MAX_HASH)
+	return ((high >> np.uint64(29)) + ((high & np.uint64((1 << 29) - 1)) << np.uint64(32))
+			+ (low >> np.uint64(61)) + (low & MERSENNE_PRIME))
+
+class MinHasher:
+	"""
+	Streams FASTQ.gz files into MinHash signatures over a hash-sampled subset of their read k-mers.
+	Permutations are (a * h + b) mod 2^61-1 over 32-bit hashes, with a and b drawn from a fixed seed so signatures
+	are comparable across runs.
+	"""
+
+	def __init__(self, kmer=21, scale=1000, num_perm=128, seed=1):
+		self.kmer = kmer
+		self.scale = scale
+		self.num_perm = num_perm
+		self.seed = seed
+		rng = np.random.RandomState(seed)
+		self.a = rng.randint(1, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+		self.b = rng.randint(0, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+		self.cutoff = np.uint64(min((1 << 64) // scale, (1 << 64) - 1))
+
+	def params(self):
+		return {'kmer': self.kmer, 'scale': self.scale, 'num_perm': self.num_perm, 'seed': self.seed}
+
+	def _update(self, signature, reads):
+		hashes = _kmer_hashes(reads, self.kmer)
+		hashes = np.unique(hashes[hashes < self.cutoff]) & MAX_HASH
+		if len(hashes):
+			permuted = ((_mulmod61(hashes[:, None], self.a) + self.b) % MERSENNE_PRIME) & MAX_HASH
+			np.minimum(signature, permuted.min(axis=0), out=signature)
+
+	def signature(self, path):
+		"""
+		Returns the MinHash signature of one FASTQ.gz, reading it once. A file with no sampled k-mers keeps MAX_HASH.
+		"""
+
+		signature = np.full(self.num_perm, MAX_HASH, dtype=np.uint64)
+		with gzip.open(path, 'rb') as f:
+			sequences = itertools.islice(f, 1, None, 4)
+			while True:
+				reads = [line.rstrip(b'\n') for line in itertools.islice(sequences, READ_BATCH_SIZE)]
+				if not reads:
+					break
+				self._update(signature, reads)
+		return signature
+
+def _signature_job(args):
+
+	path, params = args
+	try:
+		return path, MinHasher(**params).signature(path)
+	except (OSError, EOFError, zlib.error) as e:
+		print('Could not sketch {}: {}'.format(path, e))
+		return path, None
+
+def load_sketch_index(path, params):
+	"""
+	Returns {path: (size, mtime_ns, signature)} from a signature cache, or {} if it is missing or was built
+	with different MinHash parameters or an older SKETCH_INDEX_VERSION.
+	"""
+
+	if path is None or not os.path.exists(path):
+		return {}
+	with np.load(path, allow_pickle=False) as data:
+		if 'version' not in data.files or int(data['version']) != SKETCH_INDEX_VERSION or json.loads(str(data['params'])) != params:
+			return {}
+		return {p: (int(size), int(mtime_ns), signature) for p, size, mtime_ns, signature in
+				zip(data['paths'], data['sizes'], data['mtimes'], data['signatures'])}
+
+def save_sketch_index(path, params, index):
+
+	paths = sorted(index)
+	# through a file handle, so np.savez does not append .npz to a path that lacks it
+	with open(path, 'wb') as f:
+		np.savez(f, version=SKETCH_INDEX_VERSION, params=json.dumps(params), paths=np.array(paths, dtype=str),
+				 sizes=np.array([index[p][0] for p in paths], dtype=np.int64),
+				 mtimes=np.array([index[p][1] for p in paths], dtype=np.int64),
+				 signatures=np.array([index[p][2] for p in paths], dtype=np.uint64).reshape(len(paths), params['num_perm']))
+
+def lsh_candidate_pairs(signatures, bands):
+	"""
+	Locality-sensitive hashing: signatures that agree on every row of at least one band share a bucket.
+
+	Returns:
+		- pairs (set): (i, j) index pairs with i < j.
+	"""
+
+	rows = signatures.shape[1] // bands
+	pairs = set()
+	for band in range(bands):
+		buckets = {}
+		for i, key in enumerate(map(bytes, signatures[:, band * rows:(band + 1) * rows])):
+			buckets.setdefault(key, []).append(i)
+		for members in buckets.values():
+			pairs.update(itertools.combinations(members, 2))
+	return pairs
 
-	with open('/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/to_remove/duplicates.logfile.tsv', 'a') as logfile:
+def find_near_duplicates(paths, outfile, jaccard=0.5, bands=32, sketch_index=None, processes=None, annotations=None, **params):
+	"""
+	Reports pairs of FASTQ.gz files with similar read content (for example the same sample under two accessions,
+	trimmed or re-demultiplexed). Every file is streamed once into a MinHash signature (or taken from the
+	sketch_index cache), LSH picks candidate pairs without comparing all pairs, and candidates whose estimated
+	Jaccard similarity is at least jaccard are written to outfile.
 
-		for file_long in all_files_list:
+	Args:
+		- annotations (dict): optional path -> (prefix, accession, split), reported per file with a cross_split flag.
+	"""
 
-			file_short = file_long.split('/')[-1]
+	hasher_params = MinHasher(**params).params()
+	cached = load_sketch_index(sketch_index, hasher_params)
+	index = {}
+	todo = []
+	for path in paths:
+		try:
+			st = os.stat(path)
+		except OSError as e:
+			print('Could not sketch {}: {}'.format(path, e))
+			continue
+		if path in cached and cached[path][:2] == (st.st_size, st.st_mtime_ns):
+			index[path] = cached[path]
+		else:
+			index[path] = (st.st_size, st.st_mtime_ns, None)
+			todo.append(path)
 
-			if file_short in store_files_set:
-				pass
+	from_cache = len(index) - len(todo)
+	with ProcessPoolExecutor(max_workers=processes) as pool:
+		for path, signature in pool.map(_signature_job, [(path, hasher_params) for path in todo]):
+			if signature is None:
+				# skipped, and left out of the cache so it is retried next time
+				index.pop(path, None)
 			else:
-				
-				logfile.write("{}{}{}{}{}{}".format(file_short,'\t','', '\t', file_long,'\n'))
-		
-		logfile.close()
+				index[path] = index[path][:2] + (signature,)
+	if sketch_index is not None:
+		save_sketch_index(sketch_index, hasher_params, index)
+
+	# files without a single sampled k-mer carry no information and would all collide
+	paths = [path for path in paths if path in index and (index[path][2] != MAX_HASH).any()]
+	signatures = np.array([index[path][2] for path in paths], dtype=np.uint64).reshape(len(paths), hasher_params['num_perm'])
+	annotations = annotations or {}
+
+	pairs = []
+	for i, j in lsh_candidate_pairs(signatures, bands):
+		similarity = float((signatures[i] == signatures[j]).mean())
+		if similarity >= jaccard:
+			pairs.append((paths[i], paths[j], similarity))
+
+	with open(outfile, 'w') as o:
+		o.write('path_a\tpath_b\tjaccard\tprefix_a\taccession_a\tsplit_a\tprefix_b\taccession_b\tsplit_b\tcross_split\n')
+		for path_a, path_b, similarity in sorted(pairs, key=lambda pair: (-pair[2], pair[0], pair[1])):
+			a = annotations.get(path_a, ('', '', ''))
+			b = annotations.get(path_b, ('', '', ''))
+			cross_split = '' if not annotations else str(a[2] != b[2])
+			o.write('{}\t{}\t{:.3f}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(path_a, path_b, similarity, *a, *b, cross_split))
+
+	print('{} files sketched ({} from cache), {} near-duplicate pairs'.format(len(index), from_cache, len(pairs)))
+
+def _near_duplicate_inputs(input_dir=None, compare_dir=None, cp_tsvs=None):
+	"""
+	Returns (paths, annotations) for find_near_duplicates: the absolute file_path entries of the cp.tsv files, or
+	every .fastq.gz under input_dir and compare_dir.
+	"""
+
+	if cp_tsvs:
+		annotations = {}
+		for cp_tsv in cp_tsvs:
+			df = pd.read_csv(cp_tsv, sep='\t', dtype=str, keep_default_na=False)
+			for row in df.itertuples():
+				# relative entries are raw readlink targets, which only mean something next to the link
+				if not os.path.isabs(row.file_path):
+					print('Could not sketch {}: relative path in {}'.format(row.file_path, cp_tsv))
+					continue
+				annotations.setdefault(row.file_path, (row.prefix, row.accession, row.split))
+		return list(annotations), annotations
+
+	paths = []
+	for root in (input_dir, compare_dir):
+		if root:
+			paths += [path for path, size, mtime_ns in _scan_tree(root, '.fastq.gz')]
+	return sorted(set(paths)), None
 
 
 def main():
@@ -88,10 +787,31 @@ def main():
 	input_dir = args.input_dir
 	compare_dir = args.compare_dir
 
-	store_files_set, logfile = check_duplicates(input_dir)
+	if args.compare_sketches is not None:
+		compare_sketches(*args.compare_sketches)
+		return
+	if args.near_duplicates is not None:
+		paths, annotations = _near_duplicate_inputs(input_dir, compare_dir, args.cp_tsv)
+		find_near_duplicates(paths, args.near_duplicates, args.jaccard, args.bands, args.sketch_index, args.processes, annotations,
+							 kmer=args.kmer, scale=args.scale, num_perm=args.num_perm)
+		return
+	if args.build_sketch is not None:
+		build_sketch(input_dir, args.build_sketch, args.suffix, args.content, args.false_positive_rate, args.processes, args.keys_only)
+		return
+
+	if args.external_sort:
+		check_duplicates_external(input_dir, compare_dir, args.spill_dir, args.chunk_size)
+		return
+
+	index = build_basename_index(input_dir, compare_dir)
+
+	if args.content:
+		check_content_duplicates(input_dir, index, args.processes)
+	else:
+		check_duplicates(input_dir, index)
 
-	if compare_dir == compare_dir:
-		check_between_folders(compare_dir, store_files_set, logfile)
+	if compare_dir:
+		check_between_folders(compare_dir, index)
 
 if __name__ == "__main__":
     """
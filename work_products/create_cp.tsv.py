@@ -2,21 +2,44 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import csv
+import ctypes
+import ctypes.util
+import errno
+import fcntl
 import os
+import shutil
+import select
+import stat
+import struct
 
 import pandas as pd
 import re
 import datetime
+import sqlite3
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from idbd_bio_utils import ReportingNames
 
+ACCESSION_PATTERN = re.compile(r'-d-[0-9]+|-r-[0-9]+')
+DATE_PATTERN = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}')
+
+LOGFILE_PATH = '/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/all_logfiles/logfile.{}.out'
+MANIFEST_PATH = '/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/all_manifests/{}.manifest.sqlite'
+CP_TSV_PATH = '/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/all_cp_tsvs/{}.cp.tsv'
+RULES_PATH = '/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/all_rules/{}.rules.tsv'
+CP_TSV_COLUMNS = ['accession', 'file_path', 'taxids_expected',
+				  'repids_expected', 'repids_included', 'repids_excluded',
+				  'kingdom', 'prefix', 'split']
+
 
 def parse_args():
 	"""
 	Calls arguments used at the command line.
 	
 	Args:
-		required:
+		required (unless --sources is given):
 			- input_dir (str): Path to input directory.
 			- prefix (str): type of data being soured
 	Returns:
@@ -26,23 +49,57 @@ def parse_args():
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-input_dir",
 						type=str,
-						help="input is either .txt or .xlsx",
-						required=True)
+						help="input is either .txt or .xlsx")
 	parser.add_argument("-prefix",
 						type=str,
-						help="input is type of data being sourced",
-						required=True)
+						help="input is type of data being sourced")
+	parser.add_argument("--sources",
+						type=str,
+						help="tab-separated manifest with input_dir, prefix and (optional) min_file_size columns; runs every source in one job.")
+	parser.add_argument("--watch",
+						action="store_true",
+						help="keep running and update cp.tsv and the logfile from inotify events under input_dir (Linux only).")
+	parser.add_argument("--materialize",
+						type=str,
+						help="cp.tsv whose file_path entries are linked or copied into --target_dir (uses --workers threads).")
+	parser.add_argument("--target_dir",
+						type=str,
+						help="directory to fill with --materialize.")
+	parser.add_argument("--processes",
+						type=int,
+						help="number of sources crawled at once with --sources (default: one per CPU).")
 	parser.add_argument("--min_file_size",
 						type=int,
 						help="minimum threshold for file size. will issue a warning if less than given value.")
+	parser.add_argument("--rules",
+						type=str,
+						help="exclusion rule file (default: all_rules/{prefix}.rules.tsv if it exists, else the built-in rules).")
+	parser.add_argument("--workers",
+						type=int,
+						help="crawl input_dir with a pool of this many os.scandir threads instead of a single os.walk.")
+	parser.add_argument("--batch",
+						action="store_true",
+						help="parse all paths in one vectorized pass and pick the latest file per accession with a groupby.")
+	parser.add_argument("--stream",
+						action="store_true",
+						help="write cp.tsv and logfile records through batched writers without building the row list or DataFrame "
+							 "(memory then grows with accessions, not files, except with --batch, which holds every file).")
+	parser.add_argument("--manifest",
+						action="store_true",
+						help="keep a scan manifest in all_manifests/ and only re-examine directories whose mtime changed.")
 	args = parser.parse_args()
 
+	if args.materialize is not None:
+		if args.target_dir is None:
+			parser.error("--materialize requires --target_dir")
+	elif args.sources is None and (args.input_dir is None or args.prefix is None):
+		parser.error("-input_dir and -prefix are required unless --sources or --materialize is given")
 
 	return args
 
 def get_accession(file):
 
-	nuc = re.search('\-d\-[0-9]+|\-r\-[0-9]+',file)
+	nuc = ACCESSION_PATTERN.search(file)
 	try:
 		split_name = file.split(nuc[0])
 		accession = split_name[0] + str(nuc[0])
@@ -103,81 +160,1015 @@ def find_latest_from_hash(current,compared):
 		else:
 			return current
 
-def do_not_transfer(accession, acc_path_dict, filepath, logfile, min_file_size):
+class FileRecord:
+	"""
+	Metadata for one file, filled from a single lstat. For symbolic links, link_target is the readlink value and size
+	is the target's size (None if the link is broken), both resolved through a LinkResolver.
+	"""
+
+	__slots__ = ('path', 'inode', 'size', 'mtime_ns', 'is_link', 'link_target', 'accession')
+
+	def __init__(self, path, inode, size, mtime_ns, is_link, link_target, accession):
+		self.path = path
+		self.inode = inode
+		self.size = size
+		self.mtime_ns = mtime_ns
+		self.is_link = is_link
+		self.link_target = link_target
+		self.accession = accession
+
+	@classmethod
+	def from_stat(cls, path, st, resolver):
+		is_link = stat.S_ISLNK(st.st_mode)
+		link_target = None
+		size = st.st_size
+		if is_link:
+			link_target, size = resolver.resolve(path)
+		return cls(path, st.st_ino, size, st.st_mtime_ns, is_link, link_target, get_accession(path.split('/')[-1]))
+
+	@property
+	def broken(self):
+		return self.is_link and self.size is None
+
+	@property
+	def chosen_path(self):
+		"""
+		Path recorded in cp.tsv: the symbolic link target if it is a link.
+		"""
+		return self.link_target or self.path
+
+class LinkResolver:
+	"""
+	Memoized symbolic link resolution: each distinct target is stat'ed once, and a missing target directory marks every
+	link into it as broken without stat'ing the targets.
+	"""
+
+	def __init__(self):
+		self.targets = {}
+		self.dirs = {}
+
+	def resolve(self, path):
+		"""
+		Returns:
+			- link_target (str): readlink value, or None if path could not be read as a link.
+			- size (int): size of the target, or None if the link is broken.
+		"""
+
+		try:
+			link_target = os.readlink(path)
+		except OSError:
+			return None, None
+		target = os.path.join(os.path.dirname(path), link_target)
+		if target not in self.targets:
+			target_dir = os.path.dirname(target)
+			if target_dir not in self.dirs:
+				self.dirs[target_dir] = os.path.isdir(target_dir)
+			size = None
+			if self.dirs[target_dir]:
+				try:
+					size = os.stat(target).st_size
+				except OSError:
+					pass
+			self.targets[target] = size
+		return link_target, self.targets[target]
+
+def file_record(filepath, entry, resolver):
+	"""
+	Returns the FileRecord for a file from iter_files, reusing the DirEntry lstat data when there is one.
+	"""
+
+	if isinstance(entry, FileRecord):
+		return entry
+	st = entry.stat(follow_symlinks=False) if entry is not None else os.lstat(filepath)
+	return FileRecord.from_stat(filepath, st, resolver)
+
+def report_broken_links(records):
+	"""
+	Prints one summary line per target directory for a list of broken link FileRecords.
+	"""
+
+	if not records:
+		return
+	counts = {}
+	for record in records:
+		target_dir = os.path.dirname(os.path.join(os.path.dirname(record.path), record.link_target or ''))
+		counts[target_dir] = counts.get(target_dir, 0) + 1
+	print('{} broken symbolic links:'.format(len(records)))
+	for target_dir, count in sorted(counts.items(), key=lambda c: -c[1]):
+		print('\t{}\t{}'.format(count, target_dir))
+
+def parse_paths(paths):
+	"""
+	Vectorized get_accession / find_latest_from_hash parsing for a batch of paths.
+
+	Args:
+		- paths (list): file paths.
+	Returns:
+		- parsed (DataFrame): one row per path with accession, date (ISO date string), post (bool) and timestamp_key.
+
+	timestamp_key is an int64 YYYYMMDD (-1 when there is no date). It orders paths exactly like the string compare in
+	find_latest_from_hash, which only ever compares ISO dates: its hex hash pattern does not compile, so the nucleotide
+	index and hex hash are not parsed at all.
+	"""
+
+	paths = pd.Series(paths, dtype=object)
+	names = paths.str.rsplit('/', n=1).str[-1]
+
+	parsed = pd.DataFrame(index=paths.index)
+	parsed['accession'] = names.str.extract('^(.*?(?:{}))'.format(ACCESSION_PATTERN.pattern))[0].fillna(names.str.split('.', n=1).str[0])
+
+	parsed['date'] = paths.str.extract('({})'.format(DATE_PATTERN.pattern))[0]
+	parsed['post'] = paths.str.lower().str.contains('post', regex=False)
+	parsed['timestamp_key'] = parsed['date'].str.replace('-', '', regex=False).astype('float64').fillna(-1).astype('int64')
+	return parsed
+
+class _LineCollector:
+	"""
+	Stands in for the logfile so lines can be tagged with the position of the file that produced them.
+	"""
+
+	def __init__(self):
+		self.position = 0
+		self.lines = []
+
+	def write(self, line):
+		self.lines.append((self.position, line))
+
+def _duplicate_line(won, path, best_path, date, best_date):
+	if won:
+		return '{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('duplicate', 'Incoming filepath replaces existing', '.', path, best_path, date, best_date)
+	return '{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('duplicate', 'Existing filepath retained', '.', best_path, path, best_date, date)
+
+def select_latest_batch(items, logfile, min_file_size, resolver=None, broken=None, rules=None):
+	"""
+	Batch version of the get_files selection loop. Every path is parsed once by parse_paths, and the latest file per
+	accession is chosen with a groupby/argmax over timestamp_key instead of pairwise find_latest_from_hash calls.
+	The logfile receives the same lines, in the same order, as the per-file loop.
+
+	Args:
+		- items (iterable): (filepath, entry) pairs from iter_files.
+		- resolver (LinkResolver): shared link resolution cache.
+		- broken (list): broken link FileRecords are appended here.
+		- rules (ExclusionRules): applied to all files in one vectorized pass (default: built-in rules).
+	Returns:
+		- acc_path_dict (dict): accession -> chosen file path.
+	"""
+
+	if resolver is None:
+		resolver = LinkResolver()
+	if broken is None:
+		broken = []
+	if rules is None:
+		rules = ExclusionRules(min_file_size=min_file_size)
+
+	filepaths = []
+	entries = []
+	for filepath, entry in items:
+		filepaths.append(filepath)
+		entries.append(entry)
+	if not filepaths:
+		return {}
+	parsed = parse_paths(filepaths)
+	log = _LineCollector()
+
+	# the first file per accession that passes the exclusion rules is its entry; files after it compete against it,
+	# and only the excluded files before it are logged
+	records = [file_record(filepath, entry, resolver) for filepath, entry in zip(filepaths, entries)]
+	flags = rules.evaluate(records)
+	passing = flags['flag'].isna()
+	entries_first = parsed[passing].groupby('accession', sort=False).head(1)
+	entry_pos = dict(zip(entries_first['accession'], entries_first.index))
+	entry_records = {pos: records[pos] for pos in entry_pos.values()}
+	logged = ~passing & (parsed.index < parsed['accession'].map(entry_pos).fillna(len(parsed)))
+	for pos, flag, notes in zip(flags.index[logged], flags['flag'][logged], flags['notes'][logged]):
+		log.lines.append((pos, _exclusion_line(flag, notes, filepaths[pos])))
+		if flag == 'sym_link_broken':
+			broken.append(records[pos])
+
+	competing = parsed[parsed.index >= parsed['accession'].map(entry_pos).fillna(len(parsed))].copy()
+	competing['path'] = [filepaths[pos] for pos in competing.index]
+	is_entry = competing.index.isin(list(entry_pos.values()))
+	chosen = [entry_records[pos].chosen_path for pos in competing.index[is_entry]]
+	competing.loc[is_entry, 'path'] = chosen
+	competing.loc[is_entry, ['date', 'post', 'timestamp_key']] = parse_paths(chosen)[['date', 'post', 'timestamp_key']].values
+	competing['is_entry'] = is_entry
+	competing['timestamp_key'] = competing['timestamp_key'].astype('int64')
+
+	# accessions where every path has a date: the running winner is a cumulative max, the final one an argmax
+	dated = (competing['timestamp_key'] >= 0).groupby(competing['accession']).transform('all')
+	full = competing[dated]
+	by_acc = full.groupby('accession', sort=False)
+	won = (full['timestamp_key'] >= by_acc['timestamp_key'].cummax().groupby(full['accession']).shift(1)) | full['is_entry']
+	best_path = full['path'].where(won).groupby(full['accession']).ffill().groupby(full['accession']).shift(1)
+	best_date = full['date'].where(won).groupby(full['accession']).ffill().groupby(full['accession']).shift(1)
+	duplicates = ~full['is_entry']
+	for pos, w, path, bp, date, bd in zip(full.index[duplicates], won[duplicates], full['path'][duplicates], best_path[duplicates],
+										  full['date'][duplicates], best_date[duplicates]):
+		log.lines.append((pos, _duplicate_line(w, path, bp, date, bd)))
+	# ties go to the later file, as in find_latest_from_hash
+	winners = (full['timestamp_key'] * len(parsed) + full.index).groupby(full['accession']).idxmax()
+	latest = {accession: full.at[pos, 'path'] for accession, pos in winners.items()}
+
+	# accessions with an undated path fall back to the 'post' rule, which is not a total order: replay it in file order
+	for accession, group in competing[~dated].groupby('accession', sort=False):
+		rows = group.itertuples()
+		best = next(rows)
+		for row in rows:
+			if row.timestamp_key >= 0 and best.timestamp_key >= 0:
+				w = row.timestamp_key >= best.timestamp_key
+				date, bd = row.date, best.date
+			else:
+				w = not (best.post and not row.post)
+				date, bd = 'NA', 'NA'
+			log.lines.append((row.Index, _duplicate_line(w, row.path, best.path, date, bd)))
+			if w:
+				best = row
+		latest[accession] = best.path
+
+	logfile.writelines(line for pos, line in sorted(log.lines, key=lambda l: l[0]))
+	return {accession: latest[accession] for accession in sorted(entry_pos, key=entry_pos.get)}
+
+class ExclusionRules:
+	"""
+	The do_not_transfer rules (broken symbolic link, minimum file size, stop word in path), with the stop words compiled
+	into a single pattern. check() tests one FileRecord; evaluate() tests a whole batch with column operations.
+	Flags and notes are the ones written to the logfile.
+	"""
+
+	STOP_WORDS = ('downsample', 'trim', 'blk', 'poscon', 'negcon', 'demo')
+
+	def __init__(self, stop_words=STOP_WORDS, min_file_size=None, exclude_broken_links=True):
+		self.stop_words = [word.lower() for word in stop_words]
+		self.min_file_size = min_file_size
+		self.exclude_broken_links = exclude_broken_links
+		self.pattern = re.compile('|'.join(re.escape(word) for word in self.stop_words)) if self.stop_words else None
+
+	@classmethod
+	def from_file(cls, path, min_file_size=None):
+		"""
+		Reads a rule file of tab-separated 'rule<TAB>value' lines:
+			- stop_word: one per line; if any are given they replace the built-in list.
+			- min_file_size: used unless min_file_size is passed in (the command line wins).
+			- broken_links: 'exclude' (default) or 'keep'.
+		"""
+
+		stop_words = []
+		exclude_broken_links = True
+		file_min_size = None
+		with open(path) as f:
+			for line in f:
+				line = line.strip()
+				if not line or line.startswith('#'):
+					continue
+				rule, value = line.split('\t', 1)
+				if rule == 'stop_word':
+					stop_words.append(value)
+				elif rule == 'min_file_size':
+					file_min_size = int(value)
+				elif rule == 'broken_links':
+					exclude_broken_links = value != 'keep'
+				else:
+					raise ValueError('Unknown rule {} in {}'.format(rule, path))
+		return cls(stop_words or cls.STOP_WORDS, min_file_size if min_file_size is not None else file_min_size, exclude_broken_links)
+
+	def check(self, record):
+		"""
+		Returns (flag, notes) for the first rule that excludes record, or None.
+		"""
+
+		if record.broken and self.exclude_broken_links:
+			return 'sym_link_broken', 'Symbolic link does not exist.'
+		if self.min_file_size is not None and record.size is not None and record.size < self.min_file_size:
+			return 'file_size', 'File size too small ({}) -- skip file.'.format(float(record.size))
+		if self.pattern is not None:
+			match = self.pattern.search(record.path.lower())
+			if match:
+				return 'stop_word_in_path', 'Stop word {} recognized -- skip file.'.format(match[0])
+		return None
+
+	def evaluate(self, records):
+		"""
+		Returns:
+			- flags (DataFrame): flag and notes for each record, in order (both NaN where the record passes).
+		"""
+
+		paths = pd.Series([record.path for record in records], dtype=object)
+		size = pd.Series([record.size for record in records], dtype='float64')
+		broken = pd.Series([record.broken for record in records], dtype=bool)
+		flags = pd.DataFrame({'flag': pd.Series(None, index=paths.index, dtype=object),
+							  'notes': pd.Series(None, index=paths.index, dtype=object)})
+
+		# lowest priority first, so the rule do_not_transfer checks first has the last word
+		if self.pattern is not None:
+			word = paths.str.lower().str.extract('({})'.format(self.pattern.pattern))[0]
+			hit = word.notna()
+			flags.loc[hit, 'flag'] = 'stop_word_in_path'
+			flags.loc[hit, 'notes'] = 'Stop word ' + word[hit] + ' recognized -- skip file.'
+		if self.min_file_size is not None:
+			small = size < self.min_file_size
+			flags.loc[small, 'flag'] = 'file_size'
+			flags.loc[small, 'notes'] = 'File size too small (' + size[small].astype(str) + ') -- skip file.'
+		if self.exclude_broken_links:
+			flags.loc[broken, 'flag'] = 'sym_link_broken'
+			flags.loc[broken, 'notes'] = 'Symbolic link does not exist.'
+		return flags
+
+def load_rules(prefix, rules_path=None, min_file_size=None):
+	"""
+	Loads the exclusion rules for a prefix: rules_path if given, else all_rules/{prefix}.rules.tsv if it exists,
+	else the built-in rules.
+	"""
+
+	if rules_path is None and os.path.exists(RULES_PATH.format(prefix)):
+		rules_path = RULES_PATH.format(prefix)
+	if rules_path is not None:
+		return ExclusionRules.from_file(rules_path, min_file_size)
+	return ExclusionRules(min_file_size=min_file_size)
+
+def _exclusion_line(flag, notes, filepath):
+	return '{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(flag, notes, filepath, '.', '.', '.', '.')
+
+def do_not_transfer(accession, acc_path_dict, filepath, logfile, min_file_size, record=None, rules=None):
     """
     Specific rules to not add to cp.tsv
+    If record (FileRecord) is not given, one is built from a single lstat. If rules (ExclusionRules) is not given,
+    the built-in rules are used with min_file_size.
     """
-    # check if it's a symbolic link (will break if this is not done first)
-    if os.path.islink(filepath):
-        if not os.path.exists(filepath):
-            logfile.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('sym_link_broken', 'Symbolic link does not exist.', filepath, '.', '.', '.', '.'))
-            return True
-
-    # check if it's a small (or empty file)
-    file_size = float(os.stat(filepath).st_size)
-    if file_size<min_file_size:
-        logfile.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('file_size', 'File size too small ({}) -- skip file.'.format(file_size), filepath, '.', '.', '.', '.'))
+    if record is None:
+        record = file_record(filepath, None, LinkResolver())
+    if rules is None:
+        rules = ExclusionRules(min_file_size=min_file_size)
+
+    excluded = rules.check(record)
+    if excluded is not None:
+        logfile.write(_exclusion_line(excluded[0], excluded[1], filepath))
         return True
-        
-    # check if any of the stop words are in the file name    
-    bad_fastqs = {'downsample','trim','blk','poscon','negcon', 'demo'}
-    for i in bad_fastqs:
-        if i.lower() in filepath.lower():
-            logfile.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('stop_word_in_path', 'Stop word {} recognized -- skip file.'.format(i), filepath, '.', '.', '.', '.'))
-            return True
-
-def get_files(input_dir, prefix, repnames, logfile, min_file_size):
-
-	list_of_files = list()
-	for (dirpath, dirnames, filenames) in os.walk(input_dir):
-		list_of_files += [os.path.join(dirpath, file) for file in filenames if 'fastq.gz' or '.fasta' or '.fa' or '.fq' in file]
-	
-	rows = []
-	acc_path_dict = {}
-	for filepath in list_of_files:
-		file = filepath.split('/')[-1]
-		accession = get_accession(file)
 
-		if accession in acc_path_dict.keys():
-			current = filepath
-			compared = acc_path_dict[accession]
+def _scan_dir(dirpath):
+	"""
+	Lists a single directory with os.scandir.
 
-			try:
-				new, current_timestamp, compared_timestamp = find_latest_from_hash(current,compared)
-			except:
-				new = find_latest_from_hash(current,compared)
-				current_timestamp = 'NA'
-				compared_timestamp = 'NA'
-			if new == filepath:
-				logfile.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('duplicate', 'Incoming filepath replaces existing', '.', new, acc_path_dict[accession], current_timestamp, compared_timestamp))
-				acc_path_dict[accession] = new
-			elif new == acc_path_dict[accession]:
-				logfile.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('duplicate', 'Existing filepath retained', '.', new, filepath, compared_timestamp, current_timestamp,))
-				acc_path_dict[accession] = new
+	Returns:
+		- files (list): os.DirEntry objects for non-directories, sorted by name.
+		- subdirs (list): os.DirEntry objects for real (non-symlinked) subdirectories, sorted by name.
+	"""
+
+	files = []
+	subdirs = []
+	try:
+		with os.scandir(dirpath) as it:
+			for entry in it:
+				try:
+					is_dir = entry.is_dir()
+				except OSError:
+					is_dir = False
+				# same rules as os.walk: links to directories are neither files nor followed
+				if not is_dir:
+					files.append(entry)
+				elif not entry.is_symlink():
+					subdirs.append(entry)
+	except OSError:
+		pass
+
+	files.sort(key=lambda e: e.name)
+	subdirs.sort(key=lambda e: e.name)
+	return files, subdirs
+
+def scan_files(input_dir, workers):
+	"""
+	Crawls input_dir with a bounded pool of os.scandir threads and yields os.DirEntry objects for files.
+	Subdirectories are listed concurrently, but entries are yielded depth-first in name order so output is deterministic.
+	"""
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		pending = [pool.submit(_scan_dir, input_dir)]
+		while pending:
+			files, subdirs = pending.pop().result()
+			# queue the children before yielding so they are listed while this directory is consumed
+			pending.extend(reversed([pool.submit(_scan_dir, d.path) for d in subdirs]))
+			for entry in files:
+				yield entry
+
+def _check_dir(dirpath, known_mtime_ns, resolver):
+	"""
+	Stats one directory and rescans it only if its mtime differs from the manifest.
+
+	Returns:
+		- (dirpath, mtime_ns, records, subdirs), where records and subdirs are None if the directory is unchanged,
+		  or mtime_ns is None if the directory no longer exists.
+	"""
+
+	try:
+		mtime_ns = os.stat(dirpath).st_mtime_ns
+	except OSError:
+		return dirpath, None, None, None
+	if mtime_ns == known_mtime_ns:
+		return dirpath, mtime_ns, None, None
+
+	files, subdirs = _scan_dir(dirpath)
+	records = []
+	for entry in files:
+		try:
+			records.append(file_record(entry.path, entry, resolver))
+		except OSError:
+			pass
+	return dirpath, mtime_ns, records, [d.path for d in subdirs]
+
+class ScanManifest:
+	"""
+	SQLite record of every directory (path, mtime) and file (path, inode, size, mtime, symlink target, accession)
+	seen under an input directory, so reruns only rescan directories whose mtime changed.
+	Note: in-place edits to a file, or a link target changing state, do not touch the directory mtime and are not picked up.
+	"""
+
+	def __init__(self, db_path):
+		self.conn = sqlite3.connect(db_path)
+		self.conn.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, inode INTEGER, size INTEGER, "
+						  "mtime_ns INTEGER, is_link INTEGER, link_target TEXT, accession TEXT)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)")
+
+	def _subdirs(self, dirpath):
+		return [row[0] for row in self.conn.execute("SELECT path FROM dirs WHERE parent = ? ORDER BY path", (dirpath,))]
+
+	def _forget_dir(self, dirpath):
+		for subdir in self._subdirs(dirpath):
+			self._forget_dir(subdir)
+		self.conn.execute("DELETE FROM files WHERE dir = ?", (dirpath,))
+		self.conn.execute("DELETE FROM dirs WHERE path = ?", (dirpath,))
+
+	def refresh(self, input_dir, workers=None):
+		"""
+		Brings the manifest up to date with input_dir, one directory level at a time.
+		Unchanged directories cost a single stat; changed ones are rescanned (concurrently if workers is set).
+		"""
+
+		known = dict(self.conn.execute("SELECT path, mtime_ns FROM dirs"))
+		resolver = LinkResolver()
+		level = [(input_dir, None)]
+		with ThreadPoolExecutor(max_workers=workers or 1) as pool, self.conn:
+			while level:
+				next_level = []
+				results = pool.map(lambda d: _check_dir(d[0], known.get(d[0]), resolver), level)
+				for (dirpath, parent), (_, mtime_ns, records, subdirs) in zip(level, results):
+					if mtime_ns is None:
+						self._forget_dir(dirpath)
+						continue
+					if records is None:
+						subdirs = self._subdirs(dirpath)
+					else:
+						for stale in set(self._subdirs(dirpath)) - set(subdirs):
+							self._forget_dir(stale)
+						self.conn.execute("DELETE FROM files WHERE dir = ?", (dirpath,))
+						self.conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+											  [(r.path, dirpath, r.inode, r.size, r.mtime_ns, int(r.is_link), r.link_target, r.accession) for r in records])
+						self.conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (dirpath, parent, mtime_ns))
+					next_level += [(subdir, dirpath) for subdir in subdirs]
+				level = next_level
+
+	def iter_records(self, input_dir):
+		"""
+		Yields the cached FileRecords under input_dir in the same depth-first name order as scan_files.
+		"""
+
+		stack = [input_dir]
+		while stack:
+			dirpath = stack.pop()
+			for row in self.conn.execute("SELECT path, inode, size, mtime_ns, is_link, link_target, accession "
+										 "FROM files WHERE dir = ? ORDER BY path", (dirpath,)).fetchall():
+				yield FileRecord(row[0], row[1], row[2], row[3], bool(row[4]), row[5], row[6])
+			stack.extend(reversed(self._subdirs(dirpath)))
+
+	def close(self):
+		self.conn.close()
+
+def iter_files(input_dir, workers=None, manifest=None):
+	"""
+	Yields (filepath, entry) for every file under input_dir, as it is found.
+	entry is a FileRecord when a ScanManifest is given, the os.DirEntry from the scandir crawler when workers is set,
+	otherwise None (os.walk).
+	"""
+
+	if manifest is not None:
+		manifest.refresh(input_dir, workers)
+		for record in manifest.iter_records(input_dir):
+			yield record.path, record
+	elif workers:
+		for entry in scan_files(input_dir, workers):
+			yield entry.path, entry
+	else:
+		for (dirpath, dirnames, filenames) in os.walk(input_dir):
+			for file in filenames:
+				yield os.path.join(dirpath, file), None
+
+class BatchedWriter:
+	"""
+	Wraps a file object and hands lines to it in batches of batch_size with a single writelines call.
+	"""
+
+	def __init__(self, f, batch_size=10000):
+		self.f = f
+		self.batch_size = batch_size
+		self.buffer = []
+
+	def write(self, line):
+		self.buffer.append(line)
+		if len(self.buffer) >= self.batch_size:
+			self.flush()
+
+	def writelines(self, lines):
+		for line in lines:
+			self.write(line)
+
+	def flush(self):
+		self.f.writelines(self.buffer)
+		self.buffer = []
+
+def _cp_tsv_row(accession, filepath, prefix):
+	short_accession = '-'.join(accession.split('-')[-4:-2])
+	return [short_accession, filepath, '', '', '', '', '', prefix, 2]
+
+def write_cp_tsv(acc_path_dict, prefix, outfile, batch_size=10000):
+	"""
+	Streams acc_path_dict to a cp.tsv one row per accession, formatted like DataFrame.to_csv(sep='\\t', index=False).
+	The file is written beside outfile and renamed into place, so readers never see a partial cp.tsv.
+	"""
+
+	with open(outfile + '.tmp', 'w', newline='') as f:
+		batched = BatchedWriter(f, batch_size)
+		writer = csv.writer(batched, delimiter='\t', lineterminator='\n')
+		writer.writerow(CP_TSV_COLUMNS)
+		writer.writerows(_cp_tsv_row(accession, filepath, prefix) for accession, filepath in acc_path_dict.items())
+		batched.flush()
+	os.replace(outfile + '.tmp', outfile)
+
+def select_file(acc_path_dict, accession, filepath, entry, logfile, min_file_size, rules, resolver, broken):
+	"""
+	Feeds one file into acc_path_dict: the first file of an accession that passes do_not_transfer is taken, and later
+	ones replace it if find_latest_from_hash prefers them. Decisions are written to logfile.
+	"""
+
+	if accession in acc_path_dict.keys():
+		current = filepath
+		compared = acc_path_dict[accession]
+
+		try:
+			new, current_timestamp, compared_timestamp = find_latest_from_hash(current,compared)
+		except:
+			new = find_latest_from_hash(current,compared)
+			current_timestamp = 'NA'
+			compared_timestamp = 'NA'
+		if new == filepath:
+			logfile.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('duplicate', 'Incoming filepath replaces existing', '.', new, acc_path_dict[accession], current_timestamp, compared_timestamp))
+			acc_path_dict[accession] = new
+		elif new == acc_path_dict[accession]:
+			logfile.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('duplicate', 'Existing filepath retained', '.', new, filepath, compared_timestamp, current_timestamp,))
+			acc_path_dict[accession] = new
 		
+	else:
+		record = file_record(filepath, entry, resolver)
+		if record.broken:
+			broken.append(record)
+		if do_not_transfer(accession, acc_path_dict, filepath, logfile, min_file_size, record, rules):
+			pass	
 		else:
-			if do_not_transfer(accession, acc_path_dict, filepath, logfile, min_file_size):
-				pass	
+			acc_path_dict[accession] = record.chosen_path
+
+
+def get_files(input_dir, prefix, repnames, logfile, min_file_size, workers=None, manifest=None, batch=False, stream=False, rules=None):
+	"""
+	Chooses one file per accession under input_dir and writes {prefix}.cp.tsv.
+	With stream=True, log records are batched and cp.tsv is written row by row from acc_path_dict, so peak memory
+	of the per-file selection depends on the number of accessions rather than files; nothing is returned.
+	batch=True does not keep that bound even with stream=True: select_latest_batch holds every path, its
+	FileRecord, the parsed columns and all log lines until the end, so memory grows with the number of files.
+	"""
+
+	if stream:
+		logfile = BatchedWriter(logfile)
+
+	if rules is None:
+		rules = ExclusionRules(min_file_size=min_file_size)
+	resolver = LinkResolver()
+	broken = []
+
+	rows = []
+	acc_path_dict = {}
+	if batch:
+		acc_path_dict = select_latest_batch(iter_files(input_dir, workers, manifest), logfile, min_file_size, resolver, broken, rules)
+	else:
+		for filepath, entry in iter_files(input_dir, workers, manifest):
+			if isinstance(entry, FileRecord):
+				accession = entry.accession
 			else:
-				try:
-					acc_path_dict[accession] = os.readlink(filepath)
-				except:
-					acc_path_dict[accession] = filepath
+				file = filepath.split('/')[-1]
+				accession = get_accession(file)
+			select_file(acc_path_dict, accession, filepath, entry, logfile, min_file_size, rules, resolver, broken)
+
+	report_broken_links(broken)
 
+	if stream:
+		logfile.flush()
+		write_cp_tsv(acc_path_dict, prefix, CP_TSV_PATH.format(prefix))
+		return
 
 	for accession, filepath in acc_path_dict.items():
-		short_accession = '-'.join(accession.split('-')[-4:-2])
-		row = [short_accession, filepath, '', '', '', '', '', prefix, 2]
+		row = _cp_tsv_row(accession, filepath, prefix)
 		rows.append(row)
-	df = pd.DataFrame(rows, columns = ['accession', 'file_path', 'taxids_expected',
-										'repids_expected', 'repids_included', 'repids_excluded',
-										'kingdom', 'prefix', 'split'])
+	df = pd.DataFrame(rows, columns = CP_TSV_COLUMNS)
 	
-	df.to_csv('/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/all_cp_tsvs/{}.cp.tsv'.format(prefix), sep='\t', index=False)
+	df.to_csv(CP_TSV_PATH.format(prefix), sep='\t', index=False)
 
 	return(df)	
 
 
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+class Inotify:
+	"""
+	Minimal ctypes binding to Linux inotify that reports (mask, path) events.
+	"""
+
+	def __init__(self):
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+		if self.fd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+		self.paths = {}
+
+	def add_watch(self, path):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+		if wd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err), path)
+		self.paths[wd] = path
+
+	def remove_watches(self, path):
+		"""
+		Drops the watches on path and everything below it (used when a directory is moved away).
+		"""
+
+		for wd, watched in list(self.paths.items()):
+			if watched == path or watched.startswith(path + '/'):
+				self.libc.inotify_rm_watch(self.fd, wd)
+				del self.paths[wd]
+
+	def read(self, timeout):
+		"""
+		Returns the events that arrive within timeout seconds (an empty list if none do).
+		"""
+
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return []
+		data = os.read(self.fd, 1 << 16)
+		events = []
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+			name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+			offset += 16 + length
+			if mask & IN_IGNORED:
+				self.paths.pop(wd, None)
+			elif mask & IN_Q_OVERFLOW:
+				events.append((mask, None))
+			elif wd in self.paths:
+				events.append((mask, os.path.join(self.paths[wd], name) if name else self.paths[wd]))
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+class WatchState:
+	"""
+	Selection state for watch mode: the candidate files of every accession in arrival order, and the chosen path,
+	kept current with select_file as files appear and disappear.
+	"""
+
+	def __init__(self, logfile, min_file_size, rules):
+		self.logfile = logfile
+		self.min_file_size = min_file_size
+		self.rules = rules
+		self.resolver = LinkResolver()
+		self.candidates = {}
+		self.chosen_from = {}
+		self.acc_path_dict = {}
+
+	def _select(self, accession, filepath):
+		before = self.acc_path_dict.get(accession)
+		select_file(self.acc_path_dict, accession, filepath, None, self.logfile, self.min_file_size, self.rules, self.resolver, [])
+		if self.acc_path_dict.get(accession) != before:
+			self.chosen_from[accession] = filepath
+			return True
+		return False
+
+	def add(self, filepath):
+		"""
+		Returns True if the file changed the chosen path of its accession.
+		"""
+
+		accession = get_accession(filepath.split('/')[-1])
+		candidates = self.candidates.setdefault(accession, [])
+		if filepath in candidates:
+			# rewritten in place: re-evaluate it as a new arrival
+			self.remove(filepath)
+			candidates = self.candidates.setdefault(accession, [])
+		candidates.append(filepath)
+		try:
+			return self._select(accession, filepath)
+		except OSError:
+			# gone again before it could be stat'ed
+			candidates.remove(filepath)
+			return False
+
+	def remove(self, filepath):
+		"""
+		Returns True if the file was the chosen one, in which case the accession is re-selected from what is left.
+		"""
+
+		accession = get_accession(filepath.split('/')[-1])
+		candidates = self.candidates.get(accession, [])
+		if filepath not in candidates:
+			return False
+		candidates.remove(filepath)
+		if self.chosen_from.get(accession) != filepath:
+			return False
+
+		del self.chosen_from[accession]
+		self.acc_path_dict.pop(accession, None)
+		for candidate in list(candidates):
+			try:
+				self._select(accession, candidate)
+			except OSError:
+				candidates.remove(candidate)
+		if not candidates:
+			del self.candidates[accession]
+		return True
+
+	def remove_tree(self, dirpath):
+		changed = False
+		for candidates in list(self.candidates.values()):
+			for filepath in [c for c in candidates if c.startswith(dirpath + '/')]:
+				changed = self.remove(filepath) or changed
+		return changed
+
+def _watch_tree(inotify, state, dirpath):
+	"""
+	Adds watches for dirpath and every directory below it, and feeds the files already there into state, in os.walk
+	order. Each directory is watched before it is listed, so files created in between are not missed (a file seen
+	both ways is simply re-evaluated).
+	"""
+
+	changed = False
+	stack = [dirpath]
+	while stack:
+		subdir = stack.pop()
+		try:
+			inotify.add_watch(subdir)
+			with os.scandir(subdir) as it:
+				entries = sorted(it, key=lambda entry: entry.name)
+		except (FileNotFoundError, NotADirectoryError):
+			# removed again before it could be watched
+			continue
+		subdirs = []
+		for entry in entries:
+			try:
+				is_dir = entry.is_dir()
+			except OSError:
+				is_dir = False
+			if is_dir:
+				# symbolic links to directories are not followed, as in os.walk
+				if not entry.is_symlink():
+					subdirs.append(entry.path)
+			else:
+				changed = state.add(entry.path) or changed
+		stack.extend(reversed(subdirs))
+	return changed
+
+def watch_source(input_dir, prefix, min_file_size, rules=None, debounce=2.0):
+	"""
+	Long-running watch mode: builds the selection for input_dir once, then follows created, moved and deleted FASTQ
+	files through inotify. Decisions are appended to the logfile as they happen, and cp.tsv is rewritten whenever the
+	chosen paths change and events have been quiet for debounce seconds.
+	"""
+
+	if rules is None:
+		rules = ExclusionRules(min_file_size=min_file_size)
+	inotify = Inotify()
+
+	with open(LOGFILE_PATH.format(prefix), 'a') as logfile:
+		logfile.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('flag', 'notes', 'filepath', 'chosen_filepath', 'excluded_filepath', 'chosen_timestamp', 'excluded_timestamp'))
+		state = WatchState(logfile, min_file_size, rules)
+		_watch_tree(inotify, state, input_dir)
+		write_cp_tsv(state.acc_path_dict, prefix, CP_TSV_PATH.format(prefix))
+		logfile.flush()
+		print('Watching {} ({} accessions)'.format(input_dir, len(state.acc_path_dict)), flush=True)
+
+		dirty = False
+		try:
+			while True:
+				events = inotify.read(debounce)
+				if not events:
+					if dirty:
+						write_cp_tsv(state.acc_path_dict, prefix, CP_TSV_PATH.format(prefix))
+						logfile.flush()
+						dirty = False
+					continue
+
+				# link targets may have appeared or vanished since the last batch
+				state.resolver = LinkResolver()
+				for mask, path in events:
+					if path is None:
+						# the kernel queue overflowed: rebuild from a fresh crawl
+						inotify.close()
+						inotify = Inotify()
+						state = WatchState(logfile, min_file_size, rules)
+						_watch_tree(inotify, state, input_dir)
+						dirty = True
+						break
+					if mask & IN_ISDIR:
+						if mask & (IN_CREATE | IN_MOVED_TO):
+							dirty = _watch_tree(inotify, state, path) or dirty
+						elif mask & IN_MOVED_FROM:
+							inotify.remove_watches(path)
+							dirty = state.remove_tree(path) or dirty
+					elif mask & (IN_DELETE | IN_MOVED_FROM):
+						dirty = state.remove(path) or dirty
+					elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) or (mask & IN_CREATE and os.path.islink(path)):
+						# regular files count once they are closed; symbolic links never are, so take them on creation
+						dirty = state.add(path) or dirty
+		except KeyboardInterrupt:
+			pass
+		finally:
+			write_cp_tsv(state.acc_path_dict, prefix, CP_TSV_PATH.format(prefix))
+			inotify.close()
+
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 8 << 20
+
+def _copy_data(src, dst):
+	"""
+	Copies src into the new file dst without going through Python buffers where possible: a reflink (FICLONE),
+	then copy_file_range, then a chunked copy.
+
+	Returns:
+		- method (str): 'reflink', 'copy_file_range' or 'copy'.
+	"""
+
+	with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+		try:
+			fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+			return 'reflink'
+		except OSError:
+			pass
+
+		remaining = os.fstat(fsrc.fileno()).st_size
+		try:
+			while remaining > 0:
+				copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(remaining, 1 << 30))
+				if copied == 0:
+					break
+				remaining -= copied
+			if remaining == 0:
+				return 'copy_file_range'
+		except (AttributeError, OSError) as e:
+			if isinstance(e, OSError) and e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+				raise
+
+		fsrc.seek(0)
+		fdst.seek(0)
+		fdst.truncate()
+		shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_SIZE)
+		return 'copy'
+
+def materialize_file(src, target_dir):
+	"""
+	Places src in target_dir under its own name: a hardlink if possible, else a reflink or copy.
+	A target that is already the same inode, or has the same size and mtime, is left alone.
+
+	Returns:
+		- (src, status) where status is 'hardlink', 'reflink', 'copy_file_range', 'copy', 'identical' or an error message.
+	"""
+
+	if not os.path.isabs(src):
+		return src, 'error: relative path'
+	dst = os.path.join(target_dir, os.path.basename(src))
+	try:
+		st = os.stat(src)
+		try:
+			dst_st = os.stat(dst)
+			if os.path.samestat(st, dst_st) or (st.st_size == dst_st.st_size and st.st_mtime_ns == dst_st.st_mtime_ns):
+				return src, 'identical'
+		except FileNotFoundError:
+			pass
+
+		tmp = '{}.{}.tmp'.format(dst, os.getpid())
+		try:
+			try:
+				os.link(src, tmp)
+				method = 'hardlink'
+			except OSError:
+				method = _copy_data(src, tmp)
+				os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+			size = os.stat(tmp).st_size
+			if size != st.st_size:
+				os.remove(tmp)
+				return src, 'error: size mismatch ({} != {})'.format(size, st.st_size)
+			os.replace(tmp, dst)
+		except OSError:
+			if os.path.lexists(tmp):
+				os.remove(tmp)
+			raise
+		return src, method
+	except OSError as e:
+		return src, 'error: {}'.format(e)
+
+def materialize(cp_tsv, target_dir, workers=None):
+	"""
+	Fills target_dir with the file_path of every row in a cp.tsv, in parallel, without copying bytes when the
+	filesystem allows a hardlink or reflink. Prints a summary of how each file was placed.
+	Files share target_dir by basename, so paths whose basenames collide are reported as errors and none of them
+	is placed.
+	"""
+
+	os.makedirs(target_dir, exist_ok=True)
+	paths = pd.Series(pd.read_csv(cp_tsv, sep='\t', usecols=['file_path'])['file_path'].dropna().unique())
+	basenames = paths.str.rsplit('/', n=1).str[-1]
+	colliding = basenames.duplicated(keep=False)
+
+	counts = {}
+	for src, name in zip(paths[colliding], basenames[colliding]):
+		print('{}\terror: basename {} collides with another file_path'.format(src, name))
+		counts['error'] = counts.get('error', 0) + 1
+	paths = paths[~colliding]
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		for src, status in pool.map(lambda path: materialize_file(path, target_dir), paths):
+			if status.startswith('error'):
+				print('{}\t{}'.format(src, status))
+				status = 'error'
+			counts[status] = counts.get(status, 0) + 1
+
+	for status, count in sorted(counts.items()):
+		print('{}\t{}'.format(status, count))
+	return counts
+
+def run_source(input_dir, prefix, min_file_size, repnames=None, workers=None, batch=False, stream=False, use_manifest=False, rules_path=None):
+	"""
+	Runs get_files for one source: writes {prefix}.cp.tsv and appends to logfile.{prefix}.out.
+
+	Returns:
+		- prefix (str): the finished source.
+	"""
+
+	rules = load_rules(prefix, rules_path, min_file_size)
+	manifest = None
+	if use_manifest:
+		manifest = ScanManifest(MANIFEST_PATH.format(prefix))
+
+	with open(LOGFILE_PATH.format(prefix), 'a') as logfile:
+		
+		logfile.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('flag', 'notes', 'filepath', 'chosen_filepath', 'excluded_filepath', 'chosen_timestamp', 'excluded_timestamp'))
+		get_files(input_dir, prefix, repnames, logfile, min_file_size, workers, manifest, batch, stream, rules)
+	
+	logfile.close()
+	if manifest is not None:
+		manifest.close()
+
+	return prefix
+
+def run_sources(sources_path, min_file_size=None, processes=None, **kwargs):
+	"""
+	Runs every (input_dir, prefix, min_file_size) source in a tab-separated manifest across a process pool.
+	Each source writes its own cp.tsv and logfile as soon as it finishes. A blank min_file_size falls back to the
+	command line value. Remaining keyword arguments are passed to run_source.
+	"""
+
+	sources = pd.read_csv(sources_path, sep='\t', dtype={'input_dir': str, 'prefix': str})
+	if 'min_file_size' not in sources.columns:
+		sources['min_file_size'] = None
+
+	with ProcessPoolExecutor(max_workers=processes) as pool:
+		futures = {}
+		for source in sources.itertuples():
+			source_min_size = min_file_size if pd.isna(source.min_file_size) else int(source.min_file_size)
+			futures[pool.submit(run_source, source.input_dir, source.prefix, source_min_size, **kwargs)] = source.prefix
+		for future in as_completed(futures):
+			try:
+				print('{}: cp.tsv written'.format(future.result()))
+			except Exception as e:
+				print('{}: failed ({})'.format(futures[future], e))
+
 def main():
 	"""
 	Main function -- gathers input, maps, produces json output.
@@ -185,18 +1176,22 @@ def main():
 
 	#gather required command line parameters
 	args = parse_args()
-	input_dir = args.input_dir
-	prefix = args.prefix
-	min_file_size = args.min_file_size
+	options = dict(workers=args.workers, batch=args.batch, stream=args.stream, use_manifest=args.manifest, rules_path=args.rules)
 
+	if args.materialize is not None:
+		materialize(args.materialize, args.target_dir, args.workers)
+		return
+
+	# loaded once per job; get_files does not use it, so it is not shipped to the --sources workers
 	repnames = ReportingNames("/data/taxonomer2/ibergeland_work/cloned_repos/explify-config/reporting_names/explify_reporting_name_info_table.txt")
 	print(repnames)
-	with open('/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/all_logfiles/logfile.{}.out'.format(prefix), 'a') as logfile:
-		
-		logfile.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format('flag', 'notes', 'filepath', 'chosen_filepath', 'excluded_filepath', 'chosen_timestamp', 'excluded_timestamp'))
-		get_files(input_dir, prefix, repnames, logfile, min_file_size)
-	
-	logfile.close()
+
+	if args.watch:
+		watch_source(args.input_dir, args.prefix, args.min_file_size, load_rules(args.prefix, args.rules, args.min_file_size))
+	elif args.sources is not None:
+		run_sources(args.sources, args.min_file_size, args.processes, **options)
+	else:
+		run_source(args.input_dir, args.prefix, args.min_file_size, repnames, **options)
 
 
 if __name__ == "__main__":
@@ -204,4 +1199,4 @@ if __name__ == "__main__":
     main function that directs flow of code execution
     """
 
-    main() 
\ No newline at end of file
+    main()
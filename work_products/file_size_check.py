@@ -1,65 +1,368 @@
+import numpy as np
 import pandas as pd
+import argparse
 import os
 import glob
 import gzip
+import json
+import zlib
 from pathlib import Path
 
-from pandas.io.parsers import read_csv
+from concurrent.futures import ProcessPoolExecutor
+
+from manifest_diff import diff_frames
+from gz_blocks import MIN_SPLIT_SIZE, count_lines, gzip_trailer, iter_decompressed, read_read_index, sample_window, scan_gzips, split_members
+
+PAMP = "/data/analysis_group2/data_vault/datasets/analytical/pamplona/enriched/aws/release_2_reprocess/*/postqual_fastqs/*gz"
+READCOUNT_OUTFILE = "pamp_lab_initial_readcount.txt"
+PHRED_OFFSET = 33
+ESTIMATE_WINDOW_SIZE = 1 << 20
+ESTIMATE_PIECE_SIZE = 1 << 18
+Z_95 = 1.96
+
+
+def parse_args():
+	"""
+	Calls arguments used at the command line.
+
+	Returns:
+		- args (str): arg parser object.
+	"""
+
+	parser = argparse.ArgumentParser(description="Compare the initial and controlled pamplona file sizes, or count reads.")
+	parser.add_argument("--count",
+						action="store_true",
+						help="count the reads of every file matching --targets instead of comparing file sizes.")
+	parser.add_argument("--targets",
+						type=str,
+						default=PAMP,
+						help="glob of the FASTQ.gz files to count.")
+	parser.add_argument("--outfile",
+						type=str,
+						default=READCOUNT_OUTFILE,
+						help="path/readcount TSV the counts are appended to.")
+	parser.add_argument("--stats",
+						type=str,
+						help="write read count, bases, length histogram, GC fraction and per-position mean quality of every "
+							 "--targets file to this table (parquet if it ends in .parquet and pyarrow is installed, else TSV).")
+	parser.add_argument("--estimate",
+						type=str,
+						help="write approximate read counts of every --targets file, with a 95%% interval, to this TSV.")
+	parser.add_argument("--windows",
+						type=int,
+						default=8,
+						help="number of evenly spaced windows --estimate decompresses per file.")
+	parser.add_argument("--min_reads",
+						type=int,
+						help="with --estimate, count exactly the files whose interval contains this read count.")
+	parser.add_argument("--processes",
+						type=int,
+						help="number of files counted in parallel (default: one per CPU).")
+	return parser.parse_args()
 
 
 def get_readcount(filename):
+	"""
+	Counts the reads of a FASTQ.gz by counting newlines in fixed-size decompressed buffers.
+
+	Args:
+		- filename (str): path to a FASTQ.gz.
+	Returns:
+		- readcount (int): number of 4-line records.
+	"""
+
+	lines = count_lines(filename)
+	if lines % 4:
+		raise ValueError("{} has {} lines, not a multiple of 4".format(filename, lines))
+	return lines // 4
+
+
+def write_readcounts(targets, outfile, processes=None):
+	"""
+	Counts reads and appends one "path<TAB>readcount" line per file to outfile, in target order.
+	BGZF and multi-member files are split at member boundaries and their pieces counted across the process pool
+	alongside whole small files, so one large file no longer runs on a single core.
+	Files that cannot be counted (truncated, corrupt, or not a whole number of records) are reported and left out.
+	"""
+
+	parts = processes or os.cpu_count()
+	with open(outfile, "a+") as o, ProcessPoolExecutor(max_workers=processes) as pool:
+		for target, stats in scan_gzips(targets, pool, parts):
+			if isinstance(stats, Exception):
+				print('Could not count {}: {}'.format(target, stats))
+			elif stats['lines'] % 4:
+				print('Could not count {}: {} lines, not a multiple of 4'.format(target, stats['lines']))
+			else:
+				o.write("{}\t{}\n".format(target, stats['lines'] // 4))
+
+
+class FastqStats:
+	"""
+	Accumulates per-file FASTQ statistics over batches of records with NumPy.
+	"""
+
+	def __init__(self):
+		self.read_count = 0
+		self.total_bases = 0
+		self.gc = 0
+		self.acgt = 0
+		self.length_counts = np.zeros(0, dtype=np.int64)
+		self.quality_sums = np.zeros(0, dtype=np.float64)
+		self.quality_counts = np.zeros(0, dtype=np.int64)
+
+	@staticmethod
+	def _add(total, values):
+		if len(values) > len(total):
+			total = np.concatenate((total, np.zeros(len(values) - len(total), dtype=total.dtype)))
+		total[:len(values)] += values
+		return total
+
+	def update(self, lines):
+		"""
+		Adds complete records, given as a list of lines (4 per record, without newlines).
+		"""
+
+		seqs = lines[1::4]
+		quals = lines[3::4]
+		lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+		bases = b''.join(seqs).upper()
+
+		self.read_count += len(seqs)
+		self.total_bases += len(bases)
+		gc = bases.count(b'G') + bases.count(b'C')
+		self.gc += gc
+		self.acgt += gc + bases.count(b'A') + bases.count(b'T')
+		self.length_counts = self._add(self.length_counts, np.bincount(lengths))
+
+		qualities = np.frombuffer(b''.join(quals), dtype=np.uint8)
+		qual_lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+		# position of every quality character within its read
+		positions = np.arange(len(qualities)) - np.repeat(np.cumsum(qual_lengths) - qual_lengths, qual_lengths)
+		self.quality_sums = self._add(self.quality_sums, np.bincount(positions, weights=qualities.astype(np.float64) - PHRED_OFFSET))
+		self.quality_counts = self._add(self.quality_counts, np.bincount(positions))
+
+	def row(self, path):
+		lengths = np.flatnonzero(self.length_counts)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			mean_quality = np.round(self.quality_sums / self.quality_counts, 2)
+		return {'path': path,
+				'read_count': self.read_count,
+				'total_bases': self.total_bases,
+				'min_length': int(lengths[0]) if len(lengths) else 0,
+				'max_length': int(lengths[-1]) if len(lengths) else 0,
+				'mean_length': self.total_bases / self.read_count if self.read_count else 0.0,
+				'gc_fraction': self.gc / self.acgt if self.acgt else 0.0,
+				'length_histogram': {int(length): int(self.length_counts[length]) for length in lengths},
+				'mean_quality_by_position': mean_quality.tolist()}
+
+def fastq_stats(filename):
+	"""
+	Streams a FASTQ.gz once and computes its read count, total bases, read-length histogram, GC fraction (of A/C/G/T
+	bases) and per-position mean quality (Phred+33), aggregating whole decompressed buffers at a time.
+
+	Returns:
+		- row (dict): one table row; length_histogram is {length: reads}, mean_quality_by_position a list.
+	"""
+
+	stats = FastqStats()
+	pending = b''
+	for data in iter_decompressed(filename):
+		lines = (pending + data).split(b'\n')
+		# keep any incomplete record (and the unterminated last line) for the next buffer
+		complete = (len(lines) - 1) // 4 * 4
+		stats.update(lines[:complete])
+		pending = b'\n'.join(lines[complete:])
+
+	lines = pending.split(b'\n')
+	if lines[-1] == b'':
+		lines.pop()
+	if len(lines) % 4:
+		raise ValueError("{} does not end on a whole FASTQ record".format(filename))
+	stats.update(lines)
+	return stats.row(filename)
+
+def _stats_job(filename):
 
-	with gzip.open(filename, "r") as f:
-		lines = f.readlines()  # read file as bytes
- 
-		readcount = 0
-		for line in lines:
-			readcount += 1
+	try:
+		return fastq_stats(filename)
+	except (OSError, EOFError, ValueError) as e:
+		print('Could not read {}: {}'.format(filename, e))
+		return None
 
-		readcount = readcount / 4
+def write_stats(targets, outfile, processes=None):
+	"""
+	Computes fastq_stats for every target across a process pool and writes one row per file. A .parquet outfile is
+	written with pyarrow (list and map columns kept as such); otherwise, or if pyarrow is missing, a TSV with the
+	histogram and quality profile as JSON.
+	"""
+
+	with ProcessPoolExecutor(max_workers=processes) as pool:
+		rows = [row for row in pool.map(_stats_job, targets) if row is not None]
+	df = pd.DataFrame(rows, columns=['path', 'read_count', 'total_bases', 'min_length', 'max_length', 'mean_length',
+									 'gc_fraction', 'length_histogram', 'mean_quality_by_position'])
+
+	if outfile.endswith('.parquet'):
+		try:
+			import pyarrow
+		except ImportError:
+			outfile = outfile[:-len('.parquet')] + '.tsv'
+			print('pyarrow is not installed, writing {} instead'.format(outfile))
+		else:
+			df['length_histogram'] = df['length_histogram'].map(lambda histogram: list(histogram.items()))
+			df.to_parquet(outfile, index=False)
+			return
+
+	for column in ('length_histogram', 'mean_quality_by_position'):
+		df[column] = df[column].map(json.dumps)
+	df.to_csv(outfile, sep='\t', index=False)
+
+
+def _ratio_estimate(samples, denominator):
+	"""
+	Ratio estimate of reads per unit of denominator (uncompressed or compressed bytes) from window samples,
+	with its standard error.
+	"""
+
+	reads = np.array([newlines / 4 for u, newlines, c in samples])
+	sizes = np.array([u if denominator == 'uncompressed' else c for u, newlines, c in samples], dtype=np.float64)
+	ratio = reads.sum() / sizes.sum()
+	if len(samples) < 2:
+		return ratio, float('inf')
+	residuals = reads - ratio * sizes
+	return ratio, np.sqrt((residuals ** 2).sum() / (len(samples) * (len(samples) - 1))) / sizes.mean()
+
+def _t_95(df):
+	"""
+	Two-sided 95% Student t critical value (Cornish-Fisher expansion around Z_95), for the few samples a window gives.
+	"""
+
+	z = Z_95
+	return z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+
+def estimate_readcount(filename, windows=8, window_size=ESTIMATE_WINDOW_SIZE):
+	"""
+	Approximates the read count of a FASTQ.gz without decompressing all of it.
+
+	- A .fqi read index (bgzf_convert.py) gives the exact count.
+	- BGZF: the block trailers give the exact uncompressed size; windows at evenly spaced blocks give reads per
+	  uncompressed byte.
+	- Other gzip: windows at evenly spaced member boundaries (for multi-member files; a single-member file can
+	  only be entered at its start, so it yields one window at offset 0) give reads per compressed byte, which is
+	  scaled by the file size.
+
+	Each window stops at the next window's start. If together they cover the file, the count is exact (method
+	'exact'; an empty file gives 0). Otherwise each window is inflated in 256 KiB pieces, which are the samples for a ratio estimator's standard error. Pieces
+	from one window are correlated, and a single-member file is only sampled from its start, so the interval is
+	a screening aid rather than a guarantee.
+
+	Returns:
+		- estimate (dict): path, method, estimate, low and high (95% interval).
+	"""
+
+	if os.path.exists(filename + '.fqi'):
+		read_count = read_read_index(filename + '.fqi')[1]
+		return {'path': filename, 'method': 'index', 'estimate': read_count, 'low': read_count, 'high': read_count}
+
+	size = os.path.getsize(filename)
+	summary = gzip_trailer(filename)
+	bgzf = summary['format'] == 'bgzf' and not summary['truncated']
+	# BGZF block starts cost nothing to find, so even small BGZF files are sampled across their length
+	ranges = split_members(filename, windows, 0 if bgzf else MIN_SPLIT_SIZE)
+	samples = []
+	covered = True
+	for start, end in ranges:
+		window = sample_window(filename, start, end, windows * window_size // len(ranges), ESTIMATE_PIECE_SIZE)
+		covered &= sum(c for u, newlines, c in window) >= end - start
+		samples += window
+
+	# windows stop at the end of their range, so if every one reached it the whole file has been read exactly once
+	if covered:
+		read_count = sum(newlines for u, newlines, c in samples) // 4
+		return {'path': filename, 'method': 'exact', 'estimate': read_count, 'low': read_count, 'high': read_count}
+
+	if bgzf:
+		method, total = 'bgzf', summary['uncompressed_size']
+		ratio, se = _ratio_estimate(samples, 'uncompressed')
+	else:
+		method, total = 'sampled', size
+		ratio, se = _ratio_estimate(samples, 'compressed')
+	estimate = total * ratio
+	margin = _t_95(len(samples) - 1) * total * se
+	return {'path': filename, 'method': method, 'estimate': int(round(estimate)),
+			'low': int(max(0, estimate - margin)), 'high': int(estimate + margin)}
+
+def _estimate_job(filename):
+
+	try:
+		return estimate_readcount(filename)
+	except (OSError, EOFError, ValueError, zlib.error) as e:
+		print('Could not estimate {}: {}'.format(filename, e))
+		return None
+
+def write_estimates(targets, outfile, min_reads=None, processes=None):
+	"""
+	Writes estimate_readcount for every target (path, method, estimate, low, high, exact) to outfile. Files whose
+	interval contains min_reads cannot be screened from the estimate and are counted exactly (scan_gzips).
+	"""
+
+	with ProcessPoolExecutor(max_workers=processes) as pool:
+		estimates = [estimate for estimate in pool.map(_estimate_job, targets) if estimate is not None]
+		uncertain = [e['path'] for e in estimates if min_reads is not None and e['low'] <= min_reads <= e['high'] and e['low'] != e['high']]
+		exact = {}
+		for target, stats in scan_gzips(uncertain, pool, processes or os.cpu_count()):
+			if isinstance(stats, Exception):
+				print('Could not count {}: {}'.format(target, stats))
+			else:
+				exact[target] = stats['lines'] // 4
+
+	df = pd.DataFrame(estimates, columns=['path', 'method', 'estimate', 'low', 'high'])
+	df['exact'] = df['path'].map(exact).astype('Int64')
+	df.to_csv(outfile, sep='\t', index=False)
+	print('{} files estimated, {} counted exactly'.format(len(df), len(exact)))
 
-		return readcount
 
 def compare_readcounts():
+	"""
+	Prints files whose size differs between the initial and controlled manifests, and files found on only one side.
+	"""
 
 #	initial = pd.read_csv('/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/pamp_lab_initial_readcount.txt', sep='\t')
 	initial = pd.read_csv('/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/scripts/output/pamp_lab_initial_file_sizes.txt', sep='\t')
 	controlled = pd.read_csv('/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/scripts/output/pamp_lab_controlled_file_sizes.txt', sep='\t')
 #	controlled = pd.read_csv('/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/pamp_lab_controlled_readcount.txt', sep='\t')
 
-#	initial_dict = initial.set_index('file')['read_count'].to_dict()
-#	controlled_dict = controlled.set_index('file')['read_count'].to_dict()
-
-	initial_dict = initial.set_index('path')['file_size'].to_dict()
-	controlled_dict = controlled.set_index('path')['file_size'].to_dict()
-
-#	for file, read_count in initial_dict.items():
-	for file, size in initial_dict.items():
-
-#		for file_c, read_count_c in controlled_dict.items():
-		for file_c, size_c in controlled_dict.items():
-
-			if file == file_c:
-				if initial_dict[file] == controlled_dict[file_c]:
-				#	print(file, read_count)
-					pass
-				else:
-						print(file, initial_dict[file], controlled_dict[file_c])
+#	sets = diff_frames(initial, controlled, 'file', ['read_count'])
+	sets = diff_frames(initial, controlled, 'path', ['file_size'])
 
-compare_readcounts()
-#pamp = "/data/analysis_group2/data_vault/datasets/analytical/pamplona/enriched/aws/release_2_reprocess/*/postqual_fastqs/*gz"
+	for row in sets['mismatched'].itertuples(index=False):
+		print(row.path_left, row.file_size_left, row.file_size_right)
+	for path in sets['left_only']['path']:
+		print('Only in initial:', path)
+	for path in sets['right_only']['path']:
+		print('Only in controlled:', path)
 
-#targets = []
 
-#with open("pamp_lab_initial_readcount.txt", "a+") as o:
-#	for target in glob.glob(pamp):
+def main():
+	"""
+	Main function -- compares file sizes, or counts reads with --count.
+	"""
 
-#		targets.append(target)
+	args = parse_args()
 
-#	print('Targets finished.')
-#	for target in targets:
-#		readcount = get_readcount("{}".format(target))
-#		o.write("{}\t{}\n".format(target, int(readcount)))
+	if args.estimate:
+		write_estimates(sorted(glob.glob(args.targets)), args.estimate, args.min_reads, args.processes)
+	elif args.stats:
+		write_stats(sorted(glob.glob(args.targets)), args.stats, args.processes)
+	elif args.count:
+		targets = glob.glob(args.targets)
+		print('Targets finished.')
+		write_readcounts(targets, args.outfile, args.processes)
+	else:
+		compare_readcounts()
 
-#	o.close()
+if __name__ == "__main__":
+	"""
+	main function that directs flow of code execution
+	"""
 
+	main()
@@ -0,0 +1,591 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import struct
+import sys
+import zlib
+
+from functools import lru_cache
+
+GZIP_MAGIC = b'\x1f\x8b'
+CRC32_POLY = 0xedb88320
+READ_CHUNK_SIZE = 1 << 22
+# files smaller than this are not worth splitting
+MIN_SPLIT_SIZE = 1 << 26
+# how far past each split target to look for the next member header
+MEMBER_SEARCH_WINDOW = 1 << 22
+TRIAL_INFLATE_SIZE = 1 << 14
+# decompressed bytes a candidate member must produce before it is believed
+TRIAL_MIN_OUTPUT = 1 << 12
+FHCRC = 2
+FEXTRA = 4
+FNAME = 8
+FCOMMENT = 16
+# the fixed 28-byte empty block samtools/htslib append to every BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# uncompressed bytes per BGZF block, as bgzip uses, so even incompressible data fits under the 64 KiB BSIZE limit
+BGZF_BLOCK_DATA = 65280
+READ_INDEX_MAGIC = b'FQRI\x01'
+
+def parse_args():
+	"""
+	Calls arguments used at the command line.
+
+	Returns:
+		- args (str): arg parser object.
+	"""
+
+	parser = argparse.ArgumentParser(description="Report gzip trailer CRC32 and uncompressed size without decompressing.")
+	parser.add_argument("files",
+						nargs='+',
+						help=".gz files to inspect.")
+	return parser.parse_args()
+
+def _gf2_times(matrix, vector):
+
+	total = 0
+	i = 0
+	while vector:
+		if vector & 1:
+			total ^= matrix[i]
+		vector >>= 1
+		i += 1
+	return total
+
+def _gf2_multiply(a, b):
+
+	return tuple(_gf2_times(a, column) for column in b)
+
+@lru_cache(maxsize=None)
+def _zeros_operator(length):
+	"""
+	GF(2) matrix that advances a CRC-32 register over length zero bytes (as in zlib's crc32_combine).
+	Cached per length: BGZF blocks are nearly all the same size, so each distinct length is built once.
+	"""
+
+	one_bit = (CRC32_POLY,) + tuple(1 << n for n in range(31))
+	operator = one_bit
+	for _ in range(3):
+		operator = _gf2_multiply(operator, operator)
+	result = tuple(1 << n for n in range(32))
+	while length:
+		if length & 1:
+			result = _gf2_multiply(operator, result)
+		length >>= 1
+		if length:
+			operator = _gf2_multiply(operator, operator)
+	return result
+
+def crc32_combine(crc1, crc2, length2):
+	"""
+	CRC-32 of A + B from crc32(A), crc32(B) and len(B).
+	"""
+
+	return _gf2_times(_zeros_operator(length2), crc1) ^ crc2
+
+def _bgzf_block_size(header):
+	"""
+	Returns BSIZE + 1 from a member header if it carries the BGZF 'BC' extra subfield, else None.
+	"""
+
+	if len(header) < 12 or header[:2] != GZIP_MAGIC or not header[3] & FEXTRA:
+		return None
+	xlen = struct.unpack_from('<H', header, 10)[0]
+	extra = header[12:12 + xlen]
+	pos = 0
+	while pos + 4 <= len(extra):
+		si1, si2, slen = extra[pos], extra[pos + 1], struct.unpack_from('<H', extra, pos + 2)[0]
+		if (si1, si2, slen) == (66, 67, 2) and pos + 6 <= len(extra):
+			return struct.unpack_from('<H', extra, pos + 4)[0] + 1
+		pos += 4 + slen
+	return None
+
+def bgzf_blocks(fd, size):
+	"""
+	Walks a BGZF file block by block with one pread per block (the previous trailer and the next header are read together).
+
+	Yields:
+		- (offset, block_size, crc32, isize) for each block; stops early, yielding nothing more, at a block that
+		  does not fit in the file or lacks a BGZF header.
+	"""
+
+	offset = 0
+	header = os.pread(fd, 18, 0)
+	while offset < size:
+		block_size = _bgzf_block_size(header)
+		if block_size is None:
+			if len(header) > 12 and header[:2] == GZIP_MAGIC:
+				header = os.pread(fd, 12 + struct.unpack_from('<H', header, 10)[0], offset)
+				block_size = _bgzf_block_size(header)
+			if block_size is None:
+				return
+		if offset + block_size > size:
+			return
+		tail = os.pread(fd, 8 + 18, offset + block_size - 8)
+		crc, isize = struct.unpack_from('<II', tail)
+		yield offset, block_size, crc, isize
+		offset += block_size
+		header = tail[8:]
+
+def bgzf_block(data, level=6):
+	"""
+	Compresses up to BGZF_BLOCK_DATA bytes into one BGZF block (a gzip member with the 'BC' BSIZE extra field).
+	"""
+
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+	deflated = compressor.compress(data) + compressor.flush()
+	header = GZIP_MAGIC + b'\x08\x04' + b'\x00' * 4 + b'\x00\xff' + struct.pack('<H', 6) + b'BC' + struct.pack('<HH', 2, 18 + len(deflated) + 8 - 1)
+	return header + deflated + struct.pack('<II', zlib.crc32(data), len(data))
+
+def write_gzi(path, entries):
+	"""
+	Writes an htslib-compatible .gzi index: the entry count, then (compressed offset, uncompressed offset) of
+	every block after the first, all little-endian uint64.
+	"""
+
+	with open(path, 'wb') as f:
+		f.write(struct.pack('<Q', len(entries)))
+		for compressed, uncompressed in entries:
+			f.write(struct.pack('<QQ', compressed, uncompressed))
+
+def read_gzi(path):
+	"""
+	Returns the (compressed offset, uncompressed offset) block starts of a .gzi index, including the implicit (0, 0).
+	"""
+
+	with open(path, 'rb') as f:
+		n = struct.unpack('<Q', f.read(8))[0]
+		data = f.read(16 * n)
+	return [(0, 0)] + [struct.unpack_from('<QQ', data, 16 * i) for i in range(n)]
+
+def write_read_index(path, stride, read_count, offsets):
+	"""
+	Writes a read-offset sidecar: magic, stride, total read count, then the uncompressed offset of reads
+	0, stride, 2 * stride, ... as little-endian uint64. With the .gzi this locates any read without inflating
+	from the start of the file.
+	"""
+
+	with open(path, 'wb') as f:
+		f.write(READ_INDEX_MAGIC + struct.pack('<QQ', stride, read_count))
+		f.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+
+def read_read_index(path):
+	"""
+	Returns (stride, read_count, offsets) from a read-offset sidecar.
+	"""
+
+	with open(path, 'rb') as f:
+		if f.read(len(READ_INDEX_MAGIC)) != READ_INDEX_MAGIC:
+			raise ValueError("{} is not a read index".format(path))
+		stride, read_count = struct.unpack('<QQ', f.read(16))
+		data = f.read()
+	return stride, read_count, list(struct.unpack('<{}Q'.format(len(data) // 8), data))
+
+def gzip_trailer(path):
+	"""
+	Summarises a .gz file from its trailer(s) alone.
+
+	Plain gzip: the last 8 bytes give CRC32 and ISIZE (uncompressed size mod 2^32) of the last member only; that
+	describes the whole file only if it has a single member and is not cut short, which cannot be known without
+	inflating it, so members and truncated are None. With a .gzi index next to it the members are accounted for
+	one by one instead (see _indexed_summary). BGZF: every block is walked, the block CRCs are combined into the CRC32 of the whole content and the
+	ISIZEs summed into its exact size; a file that stops mid-block or lacks the EOF block is flagged truncated.
+
+	Args:
+		- path (str): path to a .gz file.
+	Returns:
+		- summary (dict): path, format ('gzip', 'bgzf' or 'not_gzip'), compressed_size, uncompressed_size, crc32,
+		  members, truncated.
+	"""
+
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		size = os.fstat(fd).st_size
+		header = os.pread(fd, 18, 0)
+		summary = {'path': path, 'format': 'not_gzip', 'compressed_size': size, 'uncompressed_size': None,
+				   'crc32': None, 'members': None, 'truncated': None}
+		if header[:2] != GZIP_MAGIC:
+			return summary
+		if size < 18:
+			summary.update(format='gzip', truncated=True)
+			return summary
+
+		if _bgzf_block_size(header) is not None:
+			crc, total, members, end = 0, 0, 0, 0
+			for offset, block_size, block_crc, isize in bgzf_blocks(fd, size):
+				crc = crc32_combine(crc, block_crc, isize)
+				total += isize
+				members += 1
+				end = offset + block_size
+			has_eof = end == size and os.pread(fd, len(BGZF_EOF), size - len(BGZF_EOF)) == BGZF_EOF
+			summary.update(format='bgzf', uncompressed_size=total, crc32=crc, members=members, truncated=not has_eof)
+			return summary
+
+		crc, isize = struct.unpack('<II', os.pread(fd, 8, size - 8))
+		summary.update(format='gzip', uncompressed_size=isize, crc32=crc)
+		if os.path.exists(path + '.gzi'):
+			summary.update(_indexed_summary(path, fd, size, read_gzi(path + '.gzi')))
+		return summary
+	finally:
+		os.close(fd)
+
+def _indexed_summary(path, fd, size, entries):
+	"""
+	Accounts for a plain multi-member file member by member from its .gzi index: every member but the last must
+	start with a gzip header and end on a trailer whose ISIZE matches the index, and the last member (whose length
+	the index does not give) is inflated. Any disagreement marks the file truncated.
+	"""
+
+	crc = 0
+	for (start, u_start), (end, u_end) in zip(entries, entries[1:]):
+		if end >= size or os.pread(fd, 2, start) != GZIP_MAGIC:
+			return {'truncated': True}
+		member_crc, isize = struct.unpack('<II', os.pread(fd, 8, end - 8))
+		if isize != (u_end - u_start) & 0xffffffff:
+			return {'truncated': True}
+		crc = crc32_combine(crc, member_crc, u_end - u_start)
+	try:
+		newlines, last, length, tail_crc, raw_crc = segment_stats(path, entries[-1][0], size)
+	except (EOFError, SegmentBoundaryError, zlib.error):
+		return {'truncated': True}
+	return {'uncompressed_size': entries[-1][1] + length, 'crc32': crc32_combine(crc, tail_crc, length),
+			'members': len(entries), 'truncated': False}
+
+def iter_decompressed(path, chunk_size=READ_CHUNK_SIZE):
+	"""
+	Yields the decompressed content of a .gz file in pieces of at most chunk_size bytes, member after member
+	(skipping zero padding between members, as gzip does), so memory stays constant whatever the file size.
+	Raises EOFError if the last member is cut short.
+	"""
+
+	decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+	partial = False
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			while chunk:
+				partial = True
+				data = decompressor.decompress(chunk, chunk_size)
+				if data:
+					yield data
+				if decompressor.eof:
+					chunk = decompressor.unused_data.lstrip(b'\x00')
+					decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+					partial = False
+				else:
+					chunk = decompressor.unconsumed_tail
+	if partial:
+		raise EOFError("Compressed file ended before the end-of-stream marker was reached: {}".format(path))
+
+def count_lines(path, chunk_size=READ_CHUNK_SIZE):
+	"""
+	Counts the lines of a .gz file with bytes.count over fixed-size decompressed buffers.
+	A final line without a trailing newline still counts.
+	"""
+
+	lines = 0
+	last = b'\n'
+	for data in iter_decompressed(path, chunk_size):
+		lines += data.count(b'\n')
+		last = data[-1:]
+	return lines + (last != b'\n')
+
+class SegmentBoundaryError(ValueError):
+	"""
+	Raised when a byte range handed to a worker does not hold whole gzip members.
+	"""
+
+def _header_size(window):
+	"""
+	Length of the gzip member header at the start of window, or None if it does not end inside the window.
+	"""
+
+	flags = window[3]
+	pos = 10
+	if flags & FEXTRA:
+		if len(window) < 12:
+			return None
+		pos = 12 + struct.unpack_from('<H', window, 10)[0]
+	for flag in (FNAME, FCOMMENT):
+		if flags & flag:
+			end = window.find(b'\x00', pos)
+			if end == -1:
+				return None
+			pos = end + 1
+	if flags & FHCRC:
+		pos += 2
+	return pos if pos < len(window) else None
+
+def _is_member_start(fd, offset, size):
+	"""
+	Checks a candidate gzip member header at offset: a BGZF header must chain to another block (or the end of the
+	file); a plain header must have sane flag bytes, end well inside the TRIAL_INFLATE_SIZE window, and inflate
+	into at least TRIAL_MIN_OUTPUT bytes (or a whole small member) that start a FASTQ record. Anything less (a long
+	extra field, say) leaves zlib still parsing the header when the window runs out, which proves nothing.
+	"""
+
+	window = os.pread(fd, TRIAL_INFLATE_SIZE, offset)
+	if len(window) < 18 or window[:3] != GZIP_MAGIC + b'\x08' or window[3] & 0xe0:
+		return False
+	block_size = _bgzf_block_size(window)
+	if block_size is not None:
+		return offset + block_size == size or _bgzf_block_size(os.pread(fd, 18, offset + block_size)) is not None
+	header_size = _header_size(window)
+	if header_size is None or header_size > TRIAL_INFLATE_SIZE // 2:
+		return False
+	try:
+		decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+		data = decompressor.decompress(window, TRIAL_MIN_OUTPUT)
+	except zlib.error:
+		return False
+	return data[:1] == b'@' and (len(data) >= TRIAL_MIN_OUTPUT or decompressor.eof)
+
+def _next_member_start(fd, offset, limit, size):
+	"""
+	First verified member header in [offset, limit), or None.
+	"""
+
+	while offset < limit:
+		window = os.pread(fd, min(READ_CHUNK_SIZE, limit - offset) + 2, offset)
+		pos = window.find(GZIP_MAGIC)
+		while pos != -1 and offset + pos < limit:
+			if _is_member_start(fd, offset + pos, size):
+				return offset + pos
+			pos = window.find(GZIP_MAGIC, pos + 1)
+		offset += len(window) - 2
+		if len(window) <= 2:
+			return None
+	return None
+
+def split_members(path, parts, min_size=MIN_SPLIT_SIZE):
+	"""
+	Splits a .gz file into up to parts byte ranges that each start on a member boundary, so they can be inflated
+	independently. BGZF files and multi-member files (pigz, concatenated lanes) split; a single-member file, or one
+	smaller than min_size, comes back as one range. A .gzi index next to the file gives the boundaries
+	directly; otherwise they are found by searching a bounded window after each target offset for a gzip header
+	that validates (see _is_member_start). A false positive is caught later, when the range before it fails to end
+	on a member trailer.
+
+	Returns:
+		- ranges (list): (start, end) byte offsets covering the whole file in order.
+	"""
+
+	size = os.path.getsize(path)
+	if parts <= 1 or size < min_size:
+		return [(0, size)]
+	if os.path.exists(path + '.gzi'):
+		offsets = [compressed for compressed, _ in read_gzi(path + '.gzi')]
+		starts = sorted({offsets[len(offsets) * i // parts] for i in range(parts)})
+		return list(zip(starts, starts[1:] + [size]))
+
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		starts = [0]
+		for i in range(1, parts):
+			target = max(size * i // parts, starts[-1] + 1)
+			start = _next_member_start(fd, target, min(target + MEMBER_SEARCH_WINDOW, size), size)
+			if start is not None and start > starts[-1]:
+				starts.append(start)
+	finally:
+		os.close(fd)
+	return list(zip(starts, starts[1:] + [size]))
+
+def segment_stats(path, start, end, chunk_size=READ_CHUNK_SIZE):
+	"""
+	Inflates the whole members in bytes [start, end) of a .gz file.
+
+	Returns:
+		- stats (tuple): (newlines, last content byte, content length, content crc32, raw crc32).
+	Raises:
+		- SegmentBoundaryError: the range does not end exactly on a member trailer (or start on a header).
+		- EOFError: the file itself ends inside a member.
+	"""
+
+	newlines, last, length, crc, raw_crc = 0, b'', 0, 0, 0
+	decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+	partial = False
+	with open(path, 'rb') as f:
+		f.seek(start)
+		remaining = end - start
+		while remaining:
+			chunk = f.read(min(chunk_size, remaining))
+			if not chunk:
+				break
+			remaining -= len(chunk)
+			raw_crc = zlib.crc32(chunk, raw_crc)
+			while chunk:
+				partial = True
+				data = decompressor.decompress(chunk, chunk_size)
+				if data:
+					newlines += data.count(b'\n')
+					length += len(data)
+					crc = zlib.crc32(data, crc)
+					last = data[-1:]
+				if decompressor.eof:
+					chunk = decompressor.unused_data.lstrip(b'\x00')
+					decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+					partial = False
+				else:
+					chunk = decompressor.unconsumed_tail
+		at_eof = not f.read(1)
+	if partial:
+		if at_eof:
+			raise EOFError("Compressed file ended before the end-of-stream marker was reached: {}".format(path))
+		raise SegmentBoundaryError("bytes {}-{} of {} do not end on a gzip member boundary".format(start, end, path))
+	return newlines, last, length, crc, raw_crc
+
+def _segment_job(args):
+
+	path, start, end = args
+	try:
+		return segment_stats(path, start, end)
+	except SegmentBoundaryError as e:
+		return e
+	except zlib.error as e:
+		if start == 0:
+			raise
+		# a false header match: the range did not start on a member
+		return SegmentBoundaryError(str(e))
+
+def _merge_segments(segments, raw_lengths):
+	"""
+	Combines per-range segment_stats in order into whole-file lines, uncompressed size, content crc32 and raw crc32.
+	"""
+
+	lines, last, length, crc, raw_crc = 0, b'\n', 0, 0, 0
+	for (newlines, seg_last, seg_length, seg_crc, seg_raw_crc), raw_length in zip(segments, raw_lengths):
+		lines += newlines
+		last = seg_last or last
+		crc = crc32_combine(crc, seg_crc, seg_length)
+		raw_crc = crc32_combine(raw_crc, seg_raw_crc, raw_length)
+		length += seg_length
+	return {'lines': lines + (last != b'\n'), 'uncompressed_size': length, 'crc32': crc, 'raw_crc32': raw_crc}
+
+def scan_gzips(paths, executor, parts):
+	"""
+	Counts lines and computes content/raw CRC32 for many .gz files at once. Every file is split at member
+	boundaries into up to parts ranges, all ranges of all files are queued on executor, and results are merged per
+	file in order. CRC32 merges exactly (crc32_combine), so the result does not depend on how the file was split.
+	A file whose ranges turn out not to fall on member boundaries is redone as a single range.
+
+	Yields:
+		- (path, stats) in paths order; stats as _merge_segments, or the exception that stopped that file.
+	"""
+
+	pending = []
+	for path in paths:
+		try:
+			ranges = split_members(path, parts)
+		except OSError as e:
+			pending.append([path, None, e, True])
+			continue
+		pending.append([path, ranges, [executor.submit(_segment_job, (path, start, end)) for start, end in ranges], len(ranges) == 1])
+
+	for i, (path, ranges, futures, whole) in enumerate(pending):
+		if ranges is None:
+			yield path, futures
+			continue
+		# retries of this and any later file whose ranges already came back misaligned go on the executor too
+		for entry in pending[i:]:
+			_queue_retry(entry, executor)
+		path, ranges, futures, whole = pending[i]
+		try:
+			segments = [future.result() for future in futures]
+			if any(isinstance(segment, SegmentBoundaryError) for segment in segments):
+				_queue_retry(pending[i], executor)
+				path, ranges, futures, whole = pending[i]
+				segments = [future.result() for future in futures]
+			yield path, _merge_segments(segments, [end - start for start, end in ranges])
+		except (OSError, EOFError, ValueError, zlib.error) as e:
+			yield path, e
+		pending[i] = None
+
+def _queue_retry(entry, executor):
+	"""
+	Resubmits a scan_gzips entry ([path, ranges, futures, whole]) as one whole-file range once any of its finished
+	ranges reports a SegmentBoundaryError.
+	"""
+
+	if entry is None or entry[3]:
+		return
+	path, ranges, futures, whole = entry
+	if any(future.done() and not future.exception() and isinstance(future.result(), SegmentBoundaryError) for future in futures):
+		for future in futures:
+			future.cancel()
+		entry[1:] = [[(0, ranges[-1][1])], [executor.submit(segment_stats, path, 0, ranges[-1][1])], True]
+
+def sample_window(path, start, end, max_output, chunk_size=1 << 20):
+	"""
+	Inflates up to max_output bytes of the range [start, end), which starts on a member boundary, reporting each
+	chunk_size piece separately so a single window still gives several samples. Nothing past end is read, so
+	windows over the ranges of split_members never overlap.
+
+	Returns:
+		- samples (list): (uncompressed bytes, newlines, compressed bytes consumed) per piece; the compressed bytes
+		  add up to end - start when the whole range was inflated.
+	"""
+
+	samples = []
+	produced = 0
+	decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+	with open(path, 'rb') as f:
+		f.seek(start)
+		remaining = end - start
+		u, newlines, c = 0, 0, 0
+		while produced < max_output and remaining:
+			chunk = f.read(min(1 << 16, remaining))
+			if not chunk:
+				break
+			remaining -= len(chunk)
+			while chunk and produced < max_output:
+				data = decompressor.decompress(chunk, min(chunk_size - u, max_output - produced))
+				leftover = decompressor.unused_data if decompressor.eof else decompressor.unconsumed_tail
+				c += len(chunk) - len(leftover)
+				u += len(data)
+				produced += len(data)
+				newlines += data.count(b'\n')
+				if u >= chunk_size:
+					samples.append((u, newlines, c))
+					u, newlines, c = 0, 0, 0
+				if decompressor.eof:
+					# zero padding between members is consumed too
+					c += len(leftover) - len(leftover.lstrip(b'\x00'))
+					leftover = leftover.lstrip(b'\x00')
+					decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+				chunk = leftover
+		if u or c:
+			samples.append((u, newlines, c))
+	return samples
+
+def trailer_key(summary):
+	"""
+	What two files must share for gzip_trailer to call them equal: (crc32, uncompressed size mod 2^32), or None
+	when the trailers cannot vouch for the whole content (not gzip, truncated, or plain gzip whose members were not
+	all accounted for).
+	"""
+
+	if summary['crc32'] is None or summary['members'] is None or summary['truncated']:
+		return None
+	return summary['crc32'], summary['uncompressed_size'] & 0xffffffff
+
+def main():
+	"""
+	Main function -- prints one TSV row per file.
+	"""
+
+	args = parse_args()
+	columns = ['path', 'format', 'compressed_size', 'uncompressed_size', 'crc32', 'members', 'truncated']
+	sys.stdout.write('\t'.join(columns) + '\n')
+	for path in args.files:
+		summary = gzip_trailer(path)
+		if summary['crc32'] is not None:
+			summary['crc32'] = '{:08x}'.format(summary['crc32'])
+		sys.stdout.write('\t'.join('' if summary[c] is None else str(summary[c]) for c in columns) + '\n')
+
+if __name__ == "__main__":
+	"""
+	main function that directs flow of code execution
+	"""
+
+	main()
@@ -1,59 +1,630 @@
+import argparse
+import gzip
 import hashlib
-import os
 import glob
-import gzip
+import math
+import os
+import sqlite3
+import zlib
 
+import numpy as np
 import pandas as pd
 
-def get_md5(filename):
-    with open(filename, "rb") as f:
-        bytes = f.read()  # read file as bytes
-        return hashlib.md5(bytes).hexdigest()
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from gz_blocks import gzip_trailer, iter_decompressed, scan_gzips, trailer_key
+from manifest_diff import diff_frames
 
-pamp_asimov = "/data/analysis_group2/data_vault/datasets/org_challenge_datasets/alloid_test_data/cd5_all_analytical/dataset/*210729B0*gz"
-pamp_aws = "/data/analysis_group2/data_vault/datasets/org_challenge_datasets/alloid_test_data/cd5_all_analytical/aws_data_processing/0.4.3/aws_output/210731-2-1/postqual_fastqs/*gz"
+PAMP_ASIMOV = "/data/analysis_group2/data_vault/datasets/org_challenge_datasets/alloid_test_data/cd5_all_analytical/dataset/*210729B0*gz"
+PAMP_AWS = "/data/analysis_group2/data_vault/datasets/org_challenge_datasets/alloid_test_data/cd5_all_analytical/aws_data_processing/0.4.3/aws_output/210731-2-1/postqual_fastqs/*gz"
+OUTFILE = "pamp_lab_source__md5.txt"
+CACHE_PATH = "/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/all_manifests/checksums.sqlite"
 
-with open("pamp_lab_source__md5.txt", "w+") as o:
+ALGORITHMS = ('md5', 'sha256', 'blake2b', 'crc32')
+HASH_CHUNK_SIZE = 1 << 20
+DIFF_BLOCK_SIZE = 1 << 22
+ETAG_OUTFILE = "pamp_lab_s3_etag.txt"
+MIB = 1 << 20
 
-    directories = [pamp_asimov, pamp_aws]
-    pamp_asimov_dict = {}
-    pamp_aws_dict = {}
 
-    for path in directories:
+def parse_args():
+    """
+    Calls arguments used at the command line.
 
-        pamp_asimov = '/'.join(pamp_asimov.split('/')[0:9])
-        pamp_aws = '/'.join(pamp_aws.split('/')[0:11])
+    Returns:
+        - args (str): arg parser object.
+    """
 
-        for target in glob.glob(path):
-            with gzip.open(target, 'rb') as f_in:
-                target = target.split('/')[-1].split('.')[0]
-#                unzipped_file = f_in.read()
+    parser = argparse.ArgumentParser(description="Compare checksums of the decompressed asimov and aws postqual fastqs.")
+    parser.add_argument("--asimov",
+                        type=str,
+                        default=PAMP_ASIMOV,
+                        help="glob of the asimov .gz files.")
+    parser.add_argument("--aws",
+                        type=str,
+                        default=PAMP_AWS,
+                        help="glob of the aws .gz files.")
+    parser.add_argument("--outfile",
+                        type=str,
+                        default=OUTFILE,
+                        help="where matching checksums are written.")
+    parser.add_argument("--algorithm",
+                        type=str,
+                        choices=ALGORITHMS,
+                        default='md5',
+                        help="digest algorithm. crc32 (written as crc32:<crc>:<size>) splits BGZF and multi-member files "
+                             "at member boundaries and inflates the pieces in parallel; the others read each file sequentially.")
+    parser.add_argument("--processes",
+                        type=int,
+                        help="number of files hashed in parallel (default: one per CPU).")
+    parser.add_argument("--cache",
+                        type=str,
+                        nargs='?',
+                        const=CACHE_PATH,
+                        help="SQLite checksum cache; files whose device, inode, size and mtime are unchanged are not re-read "
+                             "(default location: {}).".format(CACHE_PATH))
+    parser.add_argument("--trailer_fast_path",
+                        action="store_true",
+                        help="treat samples whose gzip trailers (CRC32, uncompressed size) agree as matching without hashing them; "
+                             "they are written with a crc32:<crc>:<size> token in place of the digest.")
+    parser.add_argument("--diff",
+                        type=str,
+                        nargs=2,
+                        metavar=('FASTQ_A', 'FASTQ_B'),
+                        help="instead of comparing the globs, report the first record at which two FASTQ.gz files differ.")
+    parser.add_argument("--classify",
+                        action="store_true",
+                        help="with --diff, also classify the difference as reordered, subset, truncated or different (a second pass).")
+    parser.add_argument("--s3",
+                        type=str,
+                        metavar='s3://BUCKET/PREFIX',
+                        help="instead of hashing both globs, compare the --asimov files with the ETags of the objects under this S3 prefix.")
+    parser.add_argument("--endpoint_url",
+                        type=str,
+                        help="S3-compatible endpoint for --s3 (e.g. a local MinIO or moto server).")
+    parser.add_argument("--part_size",
+                        type=int,
+                        nargs='+',
+                        default=[8, 16, 5, 15, 64],
+                        help="candidate multipart upload part sizes in MiB for --s3; every one matching an ETag's part count is tried.")
+    parser.add_argument("--etag_outfile",
+                        type=str,
+                        default=ETAG_OUTFILE,
+                        help="where the --s3 comparison is written.")
+    return parser.parse_args()
 
-#                with open('/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/scripts/md5_output/{}.postQual.fastq'.format(target), 'wb') as f_out:
-#                    f_out.write(unzipped_file)
-#                    f_out.close()
-            
 
-                md5 = get_md5('/data/analysis_group2/data_vault/datasets/analytical/all_sourced_analytical/scripts/md5_output/{}.postQual.fastq'.format(target))
+def hash_gzip(filename, algorithms=('md5',), chunk_size=HASH_CHUNK_SIZE):
+    """
+    Streams a .gz file once, hashing both the compressed bytes and the decompressed content, without writing the
+    decompressed file anywhere. Multi-member files are decompressed member after member, as gzip does. Memory stays
+    at about one chunk of compressed and one chunk of decompressed data.
 
-                if pamp_asimov in path:
-                    print('asimov', target, md5)
-                    pamp_asimov_dict[target] = md5
+    Args:
+        - filename (str): path to a .gz file.
+        - algorithms (tuple): hashlib names, e.g. ('md5', 'sha256').
+    Returns:
+        - digests (dict): {'content': {algorithm: hexdigest}, 'raw': {algorithm: hexdigest}}.
+    """
+
+    raw = [hashlib.new(algorithm) for algorithm in algorithms]
+    content = [hashlib.new(algorithm) for algorithm in algorithms]
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    partial = False
+
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            for digest in raw:
+                digest.update(chunk)
+            while chunk:
+                partial = True
+                data = decompressor.decompress(chunk, chunk_size)
+                for digest in content:
+                    digest.update(data)
+                if decompressor.eof:
+                    # gzip tolerates zero padding between members
+                    chunk = decompressor.unused_data.lstrip(b'\x00')
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    partial = False
                 else:
-                    print('aws', target, md5)
-                    pamp_aws_dict[target] = md5
+                    chunk = decompressor.unconsumed_tail
 
+    if partial:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached: {}".format(filename))
 
-        for target, md5 in pamp_asimov_dict.items():
+    return {'content': {algorithm: digest.hexdigest() for algorithm, digest in zip(algorithms, content)},
+            'raw': {algorithm: digest.hexdigest() for algorithm, digest in zip(algorithms, raw)}}
 
-            if target in pamp_aws_dict.keys():
 
-                if pamp_asimov_dict[target] != pamp_aws_dict[target]:
-                    print('Checksums differ: {}\t{}\t{}\n'.format(target,md5,pamp_aws_dict[target]))
-                elif pamp_asimov_dict[target] == pamp_aws_dict[target]:
-                    o.write("{}\t{}\t{}\t{}\n".format(target, md5, target, pamp_aws_dict[target]))
-                else:
-                    print('bad', target)
-    
-    o.close()
+def _hash_job(args):
+
+    filename, algorithms = args
+    return filename, hash_gzip(filename, algorithms)
+
+
+def hash_files(filenames, algorithms=('md5',), processes=None):
+    """
+    Hashes .gz files across a process pool. For crc32 the pieces of splittable files are spread over the pool too,
+    and the piece CRCs combined exactly; md5 and the other hashlib digests cannot be merged that way, so each file
+    is still hashed start to finish by one worker.
+
+    Returns:
+        - digests (dict): filename -> hash_gzip result.
+    """
+
+    if tuple(algorithms) == ('crc32',):
+        return _crc32_files(filenames, processes)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return dict(pool.map(_hash_job, [(filename, tuple(algorithms)) for filename in filenames], chunksize=4))
+
+
+class ChecksumCache:
+    """
+    SQLite store of content and raw digests keyed by (device, inode, size, mtime_ns, algorithm).
+    A hit costs one stat; any rewrite of the file changes its size or mtime and misses.
+    """
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS checksums (dev INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, "
+                          "algorithm TEXT, path TEXT, content TEXT, raw TEXT, PRIMARY KEY (dev, inode, size, mtime_ns, algorithm))")
+
+    @staticmethod
+    def _key(st, algorithm):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, algorithm)
+
+    def get(self, st, algorithm):
+        row = self.conn.execute("SELECT content, raw FROM checksums WHERE dev = ? AND inode = ? AND size = ? AND mtime_ns = ? "
+                                "AND algorithm = ?", self._key(st, algorithm)).fetchone()
+        return None if row is None else {'content': {algorithm: row[0]}, 'raw': {algorithm: row[1]}}
+
+    def put(self, st, algorithm, filename, digest):
+        # a new mtime for the same inode replaces the stale row rather than piling up next to it
+        self.conn.execute("DELETE FROM checksums WHERE dev = ? AND inode = ? AND algorithm = ?", (st.st_dev, st.st_ino, algorithm))
+        self.conn.execute("INSERT INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                          self._key(st, algorithm) + (filename, digest['content'][algorithm], digest['raw'][algorithm]))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def _crc32_files(filenames, processes=None):
+
+    digests = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for filename, stats in scan_gzips(filenames, pool, processes or os.cpu_count()):
+            if isinstance(stats, Exception):
+                raise stats
+            digests[filename] = {'content': {'crc32': 'crc32:{:08x}:{}'.format(stats['crc32'], stats['uncompressed_size'])},
+                                 'raw': {'crc32': 'crc32:{:08x}:{}'.format(stats['raw_crc32'], os.path.getsize(filename))}}
+    return digests
+
+
+def cached_hash_files(filenames, algorithm='md5', processes=None, cache=None):
+    """
+    hash_files for one algorithm, consulting cache first and hashing only the misses.
+    A file that changes while it is being hashed is not cached.
+    """
+
+    if cache is None:
+        return hash_files(filenames, (algorithm,), processes)
+
+    digests = {}
+    stats = {}
+    for filename in filenames:
+        stats[filename] = os.stat(filename)
+        digests[filename] = cache.get(stats[filename], algorithm)
+
+    misses = [filename for filename, digest in digests.items() if digest is None]
+    with cache.conn:
+        for filename, digest in hash_files(misses, (algorithm,), processes).items():
+            digests[filename] = digest
+            if ChecksumCache._key(os.stat(filename), algorithm) == ChecksumCache._key(stats[filename], algorithm):
+                cache.put(stats[filename], algorithm, filename, digest)
+    return digests
+
+
+def _sample_name(filename):
+    return filename.split('/')[-1].split('.')[0]
+
+
+def trailer_matches(asimov_files, aws_files):
+    """
+    Pairs samples by name and compares their gzip trailers, which costs a few seeks per file instead of a full read.
+    Equal (CRC32, size) is taken as equal content only where the trailers cover the whole file and it is not
+    truncated: BGZF, or plain gzip with a .gzi index (see gzip_trailer). Plain gzip without one shows only its last
+    member's trailer, so those samples, and any whose trailers differ, are left to be hashed.
+
+    Returns:
+        - matches (dict): sample name -> 'crc32:<crc>:<size>' for samples whose trailers agree.
+    """
+
+    aws_by_name = {_sample_name(filename): filename for filename in aws_files}
+    matches = {}
+    for filename in asimov_files:
+        target = _sample_name(filename)
+        if target in aws_by_name:
+            key = trailer_key(gzip_trailer(filename))
+            if key is not None and key == trailer_key(gzip_trailer(aws_by_name[target])):
+                matches[target] = 'crc32:{:08x}:{}'.format(*key)
+    return matches
+
+
+def collect_checksums(filenames, label, algorithm='md5', processes=None, cache=None):
+    """
+    Returns {sample name: content digest} for filenames, printing each as it did before.
+    """
+
+    checksums = {}
+    digests = cached_hash_files(filenames, algorithm, processes, cache)
+    for filename, digest in digests.items():
+        target = _sample_name(filename)
+        print(label, target, digest['content'][algorithm], digest['raw'][algorithm])
+        checksums[target] = digest['content'][algorithm]
+    return checksums
+
+
+def compare_checksums(pamp_asimov_dict, pamp_aws_dict, outfile):
+    """
+    Writes samples whose checksums agree to outfile and prints those that differ, and how many samples were
+    found on only one side.
+    """
+
+    asimov = pd.DataFrame({'target': list(pamp_asimov_dict), 'md5': list(pamp_asimov_dict.values())})
+    aws = pd.DataFrame({'target': list(pamp_aws_dict), 'md5': list(pamp_aws_dict.values())})
+    sets = diff_frames(asimov, aws, 'target', ['md5'])
+
+    for row in sets['mismatched'].itertuples(index=False):
+        print('Checksums differ: {}\t{}\t{}\n'.format(row.target_left, row.md5_left, row.md5_right))
+    with open(outfile, "w+") as o:
+        for row in sets['matched'].itertuples(index=False):
+            o.write("{}\t{}\t{}\t{}\n".format(row.target_left, row.md5_left, row.target_right, row.md5_right))
+    if len(sets['left_only']) or len(sets['right_only']):
+        print('{} samples only in asimov, {} only in aws'.format(len(sets['left_only']), len(sets['right_only'])))
+
+
+def _record_start(data, newlines_before):
+    """
+    Offset in data just after the newline that ends the last complete FASTQ record, or 0 if there is none.
+    newlines_before is the number of newlines in the stream before data.
+    """
+
+    end = len(data)
+    line = newlines_before + data.count(b'\n') - 1
+    while line >= newlines_before:
+        end = data.rfind(b'\n', 0, end)
+        if line % 4 == 3:
+            return end + 1
+        line -= 1
+    return 0
+
+
+def _first_line(data):
+    return data.split(b'\n', 1)[0].decode(errors='replace') if data else '<end of file>'
+
+
+def first_difference(file_a, file_b, block_size=DIFF_BLOCK_SIZE):
+    """
+    Streams two FASTQ.gz files in lockstep, comparing large decompressed blocks, and stops at the first byte that
+    differs. Both files are identical up to that byte, so the record containing it is located in the shared data.
+
+    Returns:
+        - difference (dict or None): None if the files decompress to the same bytes; otherwise record (0-based index
+          of the first differing record), header_a, header_b, and truncated ('a' or 'b' if that file is a strict
+          prefix of the other, else None).
+    """
+
+    with gzip.open(file_a, 'rb') as fa, gzip.open(file_b, 'rb') as fb:
+        newlines = 0
+        # the common bytes from the start of the current record, carried over from the previous block
+        tail = b''
+        while True:
+            block_a = fa.read(block_size)
+            block_b = fb.read(block_size)
+            if block_a == block_b:
+                if not block_a:
+                    return None
+                start = _record_start(block_a, newlines)
+                tail = block_a[start:] if start else tail + block_a
+                newlines += block_a.count(b'\n')
+                continue
+
+            common = len(os.path.commonprefix([block_a, block_b]))
+            shared = tail + block_a[:common]
+            newlines_in_tail = tail.count(b'\n')
+            start = _record_start(shared, newlines - newlines_in_tail)
+            line = newlines + block_a[:common].count(b'\n')
+            record_a = shared[start:] + block_a[common:] + fa.read(1 << 16)
+            record_b = shared[start:] + block_b[common:] + fb.read(1 << 16)
+
+            truncated = None
+            if common == len(block_a) and not record_a[len(shared) - start:]:
+                truncated = 'a'
+            elif common == len(block_b) and not record_b[len(shared) - start:]:
+                truncated = 'b'
+            return {'record': line // 4, 'header_a': _first_line(record_a), 'header_b': _first_line(record_b), 'truncated': truncated}
+
+
+def _hash_records(lines):
+    """
+    64-bit hashes of the records in a list of lines (4 per record, without newlines), as an int64 array.
+    """
+
+    records = zip(*[iter(lines)] * 4)
+    return np.fromiter((hash(b'\n'.join(record)) for record in records), dtype=np.int64, count=len(lines) // 4)
+
+
+def _record_hashes(filename):
+    """
+    Sorted 64-bit hashes of every 4-line record in a FASTQ.gz. Hashes are collected into one int64 array per
+    decompressed buffer, as FastqStats does, so memory is 8 bytes per record rather than a Python int each.
+    An incomplete last record is ignored.
+    """
+
+    batches = []
+    pending = b''
+    for data in iter_decompressed(filename):
+        lines = (pending + data).split(b'\n')
+        # keep any incomplete record (and the unterminated last line) for the next buffer
+        complete = (len(lines) - 1) // 4 * 4
+        batches.append(_hash_records(lines[:complete]))
+        pending = b'\n'.join(lines[complete:])
+    lines = pending.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    batches.append(_hash_records(lines[:len(lines) // 4 * 4]))
+    hashes = np.concatenate(batches)
+    hashes.sort()
+    return hashes
+
+
+def classify_difference(file_a, file_b, difference):
+    """
+    Classifies how two differing FASTQ.gz files relate by comparing their sets of record hashes:
+    truncated (one is a prefix of the other), reordered (same records, different order),
+    subset (every record of one is in the other) or different.
+
+    Returns:
+        - (kind, only_a, only_b): kind and the number of records found in just one file.
+    """
+
+    hashes_a = _record_hashes(file_a)
+    hashes_b = _record_hashes(file_b)
+    only_a = int((~np.isin(hashes_a, hashes_b)).sum())
+    only_b = int((~np.isin(hashes_b, hashes_a)).sum())
+
+    if difference['truncated']:
+        kind = 'truncated ({} is a prefix)'.format(difference['truncated'])
+    elif len(hashes_a) == len(hashes_b) and np.array_equal(hashes_a, hashes_b):
+        kind = 'reordered'
+    elif only_a == 0:
+        kind = 'subset (a within b)'
+    elif only_b == 0:
+        kind = 'subset (b within a)'
+    else:
+        kind = 'different'
+    return kind, only_a, only_b
+
+
+def diff_fastqs(file_a, file_b, classify=False):
+    """
+    Prints where (and optionally how) two FASTQ.gz files differ.
+    """
+
+    difference = first_difference(file_a, file_b)
+    if difference is None:
+        print('identical content: {}\t{}'.format(file_a, file_b))
+        return
+    print('first differing record: {}\n  a: {}\n  b: {}'.format(difference['record'], difference['header_a'], difference['header_b']))
+    if classify:
+        print('difference: {}; {} records only in a, {} only in b'.format(*classify_difference(file_a, file_b, difference)))
+
+
+def multipart_etags(filename, part_sizes, multipart=False, chunk_size=HASH_CHUNK_SIZE):
+    """
+    ETags S3 gives an object uploaded in each of part_sizes, from a single read of the file: the plain MD5 for a
+    single PUT, otherwise the MD5 of the concatenated part MD5s followed by -<number of parts>. A multipart upload
+    of one part still has the -1 form, so multipart says which kind of upload to reproduce.
+
+    Returns:
+        - etags (dict): part size -> ETag.
+    """
+
+    parts = {part_size: [] for part_size in part_sizes}
+    current = {part_size: hashlib.md5() for part_size in part_sizes}
+    position = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            for part_size in part_sizes:
+                offset = 0
+                while offset < len(chunk):
+                    # bytes left in the current part of this size
+                    take = part_size - (position + offset) % part_size
+                    current[part_size].update(chunk[offset:offset + take])
+                    offset += take
+                    if offset <= len(chunk):
+                        parts[part_size].append(current[part_size].digest())
+                        current[part_size] = hashlib.md5()
+            position += len(chunk)
+
+    etags = {}
+    for part_size in part_sizes:
+        digests = parts[part_size]
+        if position % part_size or not digests:
+            digests = digests + [current[part_size].digest()]
+        if len(digests) == 1 and not multipart:
+            etags[part_size] = digests[0].hex()
+        else:
+            etags[part_size] = '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+    return etags
+
+
+def multipart_etag(filename, part_size, multipart=False, chunk_size=HASH_CHUNK_SIZE):
+    """
+    ETag of filename uploaded in part_size parts (see multipart_etags).
+    """
+
+    return multipart_etags(filename, [part_size], multipart, chunk_size)[part_size]
+
+
+def _part_sizes_for(etag, size, part_sizes):
+    """
+    Every candidate part size that splits size into as many parts as etag says it has, then one that reproduces the
+    part count in case the uploader used another size (None for ETags without a -N suffix, which were not
+    multipart uploads). Sizes with the same part count can still give different ETags, so all are tried.
+    """
+
+    if '-' not in etag:
+        return None
+    n_parts = int(etag.rsplit('-', 1)[1])
+    candidates = [part_size for part_size in part_sizes if math.ceil(size / part_size) == n_parts]
+    fallback = max(1, math.ceil(size / n_parts))
+    return candidates + ([fallback] if fallback not in candidates else [])
+
+
+def _etag_job(args):
+    """
+    Returns (filename, (local ETag, part size)): the first candidate's ETag that equals remote_etag, else the first
+    candidate's. The part size is '' for a single PUT or when nothing matched.
+    """
+
+    filename, part_sizes, remote_etag = args
+    if part_sizes is None:
+        return filename, (multipart_etag(filename, os.path.getsize(filename) or 1), '')
+    etags = multipart_etags(filename, part_sizes, multipart=True)
+    for part_size in part_sizes:
+        if etags[part_size] == remote_etag:
+            return filename, (etags[part_size], part_size)
+    return filename, (etags[part_sizes[0]], '')
+
+
+def _split_s3_url(url):
+
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+def list_bucket_etags(url, endpoint_url=None, workers=16):
+    """
+    Lists every object under an s3:// prefix. The top-level "directories" (delimiter '/') are paginated concurrently,
+    one thread each, since a single listing is a strictly sequential chain of pages.
+    boto3 is only needed for this mode and is imported here.
+
+    Returns:
+        - objects (dict): key -> (size, etag without quotes).
+    """
+
+    import boto3
+
+    bucket, prefix = _split_s3_url(url)
+    client = boto3.client('s3', endpoint_url=endpoint_url)
+    paginator = client.get_paginator('list_objects_v2')
+
+    def list_prefix(sub_prefix, delimiter=None):
+        objects, prefixes = {}, []
+        kwargs = {'Bucket': bucket, 'Prefix': sub_prefix}
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        for page in paginator.paginate(**kwargs):
+            for obj in page.get('Contents', []):
+                objects[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+            prefixes += [p['Prefix'] for p in page.get('CommonPrefixes', [])]
+        return objects, prefixes
+
+    objects, prefixes = list_prefix(prefix, delimiter='/')
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for sub_objects, _ in pool.map(list_prefix, prefixes):
+            objects.update(sub_objects)
+    return objects
+
+
+def compare_s3_etags(filenames, url, outfile, part_sizes=(8,), endpoint_url=None, processes=None):
+    """
+    Checks local copies against an S3 prefix without downloading: objects are listed with their ETags, matched to
+    local files by basename, and each local file's ETag is recomputed for every candidate part size consistent with
+    the remote part count. Writes basename, local path, key, size, local ETag, remote ETag, the part size that
+    matched and status (match, etag_mismatch, size_mismatch, missing_remote, missing_local, or duplicate_name when
+    several objects or local files share a basename and cannot be paired) to outfile.
+    """
+
+    part_sizes = [part_size * MIB for part_size in part_sizes]
+    objects = list_bucket_etags(url, endpoint_url)
+    remote, local = {}, {}
+    for key, (size, etag) in objects.items():
+        remote.setdefault(key.split('/')[-1], []).append((key, size, etag))
+    for filename in filenames:
+        local.setdefault(filename.split('/')[-1], []).append(filename)
+    duplicates = {name for side in (remote, local) for name, entries in side.items() if len(entries) > 1}
+
+    jobs = []
+    for name, (filename,) in ((name, entries) for name, entries in local.items() if name not in duplicates):
+        if name in remote and os.path.getsize(filename) == remote[name][0][1]:
+            key, size, etag = remote[name][0]
+            jobs.append((filename, _part_sizes_for(etag, size, part_sizes), etag))
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        local_etags = dict(pool.map(_etag_job, jobs, chunksize=4))
+
+    counts = {}
+    with open(outfile, 'w') as o:
+        o.write('name\tlocal_path\tkey\tsize\tlocal_etag\tremote_etag\tpart_size\tstatus\n')
+        for name in sorted(set(local) | set(remote)):
+            if name in duplicates:
+                rows = [(filename, '', '', os.path.getsize(filename)) for filename in local.get(name, [])]
+                rows += [('', key, etag, size) for key, size, etag in remote.get(name, [])]
+                for filename, key, etag, size in rows:
+                    counts['duplicate_name'] = counts.get('duplicate_name', 0) + 1
+                    o.write('{}\t{}\t{}\t{}\t\t{}\t\t{}\n'.format(name, filename, key, size, etag, 'duplicate_name'))
+                continue
+
+            filename = local.get(name, [''])[0]
+            key, size, etag = remote.get(name, [('', '', '')])[0]
+            local_etag, part_size = local_etags.get(filename, ('', ''))
+            if not filename:
+                status = 'missing_local'
+            elif not key:
+                status = 'missing_remote'
+                size = os.path.getsize(filename)
+            elif filename not in local_etags:
+                status = 'size_mismatch'
+            else:
+                status = 'match' if local_etag == etag else 'etag_mismatch'
+            counts[status] = counts.get(status, 0) + 1
+            o.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(name, filename, key, size, local_etag, etag, part_size, status))
+    print(', '.join('{} {}'.format(n, status) for status, n in sorted(counts.items())))
+
+
+def main():
+    """
+    Main function -- hashes both sources and compares them.
+    """
+
+    args = parse_args()
+    if args.diff:
+        diff_fastqs(*args.diff, classify=args.classify)
+        return
+    if args.s3:
+        compare_s3_etags(sorted(glob.glob(args.asimov)), args.s3, args.etag_outfile, args.part_size, args.endpoint_url, args.processes)
+        return
+
+    cache = ChecksumCache(args.cache) if args.cache else None
+
+    asimov_files = sorted(glob.glob(args.asimov))
+    aws_files = sorted(glob.glob(args.aws))
+
+    matches = trailer_matches(asimov_files, aws_files) if args.trailer_fast_path else {}
+    if matches:
+        print('{} samples matched on gzip trailers'.format(len(matches)))
+        asimov_files = [filename for filename in asimov_files if _sample_name(filename) not in matches]
+        aws_files = [filename for filename in aws_files if _sample_name(filename) not in matches]
+
+    pamp_asimov_dict = dict(matches, **collect_checksums(asimov_files, 'asimov', args.algorithm, args.processes, cache))
+    pamp_aws_dict = dict(matches, **collect_checksums(aws_files, 'aws', args.algorithm, args.processes, cache))
+    compare_checksums(pamp_asimov_dict, pamp_aws_dict, args.outfile)
+
+    if cache is not None:
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()